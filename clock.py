@@ -0,0 +1,112 @@
+import numpy as np
+
+# The Shimmer3 timestamp channel is a 24 bit counter of its 32768 Hz real-time clock
+TICK_RATE = 32768.0
+TICK_WRAP = 2 ** 24
+# Largest relative difference in speed between the device and host clocks we believe
+MAX_DRIFT = 0.001
+
+
+def unwrap_ticks(ticks, tick_wrap: int = TICK_WRAP) -> np.ndarray:
+    """Undo the rollovers of a stored tick counter, e.g. sensor_data.data_timestamp of one session."""
+    ticks = np.asarray(ticks, dtype=np.int64)
+    wraps = np.cumsum(np.diff(ticks, prepend=ticks[:1]) < -tick_wrap // 2)
+    return ticks + wraps * tick_wrap
+
+
+class ClockAligner:
+    """
+    Turns the device's tick counter into host timestamps.
+
+    Host arrival times jitter with the Bluetooth batching, the device ticks don't. The counter is unwrapped and
+    a least squares line from device seconds to host seconds is fitted over all batches, so the slope absorbs the
+    drift between both clocks. Samples then get evenly spaced timestamps straight from their ticks.
+    """
+
+    def __init__(self, sampling_rate: float, tick_rate: float = TICK_RATE, tick_wrap: int = TICK_WRAP):
+        self.tick_rate = tick_rate
+        self.tick_wrap = tick_wrap
+        self.period_ticks = tick_rate / sampling_rate
+        self.period = 1.0 / sampling_rate
+        self.reset()
+
+    def reset(self):
+        self.first_tick = None
+        self.last_tick = None  # unwrapped
+        self.wraps = 0
+        self.anchor = None  # host time of the first batch, keeps the fit well conditioned
+        self.last_time = None  # timestamp of the last sample handed out
+
+        # Running sums for the least squares fit of host seconds on device seconds
+        self.n = 0
+        self.sum_x = self.sum_y = self.sum_xx = self.sum_xy = 0.0
+
+        self.dropped = 0
+        self.gaps = []  # (device seconds, missing samples)
+
+    def unwrap(self, ticks: np.ndarray) -> np.ndarray:
+        ticks = np.asarray(ticks, dtype=np.int64)
+        previous = self.last_tick % self.tick_wrap if self.last_tick is not None else ticks[0]
+        steps = np.diff(ticks, prepend=previous)
+        # A large step backwards means the counter rolled over
+        wraps = self.wraps + np.cumsum(steps < -self.tick_wrap // 2)
+        self.wraps = int(wraps[-1])
+        return ticks + wraps * self.tick_wrap
+
+    def align(self, ticks, host_time: float) -> np.ndarray:
+        """
+        Timestamps (seconds since the epoch) for one batch of samples.
+
+        host_time is the time the batch arrived, i.e. the host time belonging to its last sample.
+        """
+        ticks = self.unwrap(ticks)
+        if self.first_tick is None:
+            self.first_tick = ticks[0]
+            self.anchor = host_time
+
+        self.count_gaps(ticks)
+        self.last_tick = int(ticks[-1])
+
+        x = (ticks - self.first_tick) / self.tick_rate
+        self.add_observation(x[-1], host_time - self.anchor)
+        slope, intercept = self.fit()
+        times = self.anchor + intercept + slope * x
+
+        # The fit moves with every batch, but a batch may never start before the previous one ended: datetime is
+        # part of the sensor_data key. Such a batch is squeezed in after the previous one and ends on the fit, or
+        # catches up with it at half speed when the fit is further behind. Samples stay at least half a period
+        # apart, which sensor_data.datetime (datetime2(6) since migration 001) keeps apart at any Shimmer rate
+        if self.last_time is not None and times[0] < self.last_time + self.period / 2:
+            start = self.last_time + self.period / 2
+            span = x[-1] - x[0]
+            end = max(times[-1], start + span / 2)
+            times = start + (x - x[0]) * ((end - start) / span if span > 0 else 0.0)
+        self.last_time = float(times[-1])
+        return times
+
+    def count_gaps(self, ticks):
+        previous = self.last_tick if self.last_tick is not None else ticks[0]
+        missing = np.rint(np.diff(ticks, prepend=previous) / self.period_ticks) - 1
+        gaps = np.flatnonzero(missing > 0)
+        if len(gaps):
+            self.dropped += int(missing[gaps].sum())
+            self.gaps.extend(zip(((ticks[gaps] - self.first_tick) / self.tick_rate).tolist(),
+                                 missing[gaps].astype(int).tolist()))
+
+    def add_observation(self, x, y):
+        self.n += 1
+        self.sum_x += x
+        self.sum_y += y
+        self.sum_xx += x * x
+        self.sum_xy += x * y
+
+    def fit(self):
+        denominator = self.n * self.sum_xx - self.sum_x ** 2
+        # Until there's enough spread to estimate drift, assume both clocks run at the same speed
+        if self.n < 2 or denominator < 1e-9:
+            return 1.0, (self.sum_y - self.sum_x) / self.n
+        slope = (self.n * self.sum_xy - self.sum_x * self.sum_y) / denominator
+        # Crystal drift is in the ppm range, anything steeper comes from a burst of delayed packets
+        slope = min(max(slope, 1.0 - MAX_DRIFT), 1.0 + MAX_DRIFT)
+        intercept = (self.sum_y - slope * self.sum_x) / self.n
+        return slope, intercept
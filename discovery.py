@@ -0,0 +1,373 @@
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import shared_memory
+from serial import Serial
+from serial.tools import list_ports
+from pyshimmer import ShimmerBluetooth, DEFAULT_BAUDRATE
+from live_bus import bus_exists
+from storage import Storage, SqliteStorage, open_storage
+
+# Background discovery of Shimmers, so pressing Start only hands over a device that is already connected.
+# Usage: python discovery.py                  list the Shimmers on this machine
+#        python discovery.py --simulate 8     scan 8 simulated ports, compared with one after the other
+
+# Held by the one process on this machine that runs discovery, probing a port from two processes at once would
+# lock one of them out (Windows) or mix up the init commands (Linux)
+DISCOVERY_LOCK = "shimmer_discovery"
+# Seconds a write to a port may take, e.g. a Bluetooth port whose device is out of range
+WRITE_TIMEOUT = 2.0
+
+
+def open_shimmer(com_port):
+    # No read timeout: pyshimmer takes a short read for a cancelled read loop. Queries are limited with
+    # call_with_timeout instead
+    serial = Serial(com_port, DEFAULT_BAUDRATE, write_timeout=WRITE_TIMEOUT)
+    return serial, ShimmerBluetooth(serial)
+
+
+def call_with_timeout(timeout, cancel, query, *args):
+    """
+    query(*args), or TimeoutError when it takes longer than `timeout` seconds.
+
+    pyshimmer waits for a reply without a timeout, so a device that opened but never answers blocks the query for
+    good. After `timeout` seconds cancel() is called, which should shut the device down: that releases the waiting
+    query.
+    """
+    expired = threading.Event()
+
+    def expire():
+        expired.set()
+        cancel()
+
+    timer = threading.Timer(timeout, expire)
+    timer.start()
+    try:
+        result = query(*args)
+    except Exception:
+        if expired.is_set():
+            raise TimeoutError(f"No answer within {timeout:.0f}s")
+        raise
+    finally:
+        timer.cancel()
+    if expired.is_set():
+        raise TimeoutError(f"No answer within {timeout:.0f}s")
+    return result
+
+
+class WarmDevice:
+    """A Shimmer that is open, initialized and registered, but not streaming yet."""
+
+    def __init__(self, com_port, serial, shim_dev, name, battery, sampling_rate, shimmer_id):
+        self.com_port = com_port
+        self.serial = serial
+        self.shim_dev = shim_dev
+        self.name = name
+        self.battery = battery
+        self.sampling_rate = sampling_rate
+        self.shimmer_id = shimmer_id
+        self.checked = time.time()
+        # Held while discovery talks to the device, so it is never handed over in the middle of a query
+        self.lock = threading.Lock()
+        self.closed = False
+        self.close_lock = threading.Lock()
+
+    def close(self):
+        # Also cancels a query that timed out, and shutting pyshimmer down twice fails
+        with self.close_lock:
+            if self.closed:
+                return
+            self.closed = True
+        try:
+            self.shim_dev.shutdown()
+        finally:
+            if self.serial is not None:
+                self.serial.close()
+
+
+class DeviceDiscovery:
+    """
+    Scans the serial ports in the background and keeps every Shimmer it finds warm.
+
+    Opening a port, initializing the device, asking its name, battery and sampling rate and registering it in the
+    database take seconds per device, so all ports are probed in parallel. Devices that answered stay open and are
+    handed over by claim() and take(); their battery state is refreshed on every scan. The devices are registered
+    with the given storage, so ShimmerDevice must use the same storage when it takes one over.
+
+    Ports that an acquisition daemon (shimmer_run.py) publishes on a LiveBus are left alone, and only one process
+    per machine scans: start() does nothing when another process already holds the discovery lock.
+
+    A port that opens but never answers (a modem, or a Bluetooth port whose device is out of range) would block its
+    probe for good, so the handshake is given up after handshake_timeout seconds and a battery query after
+    query_timeout seconds.
+    """
+
+    def __init__(self, storage: Storage, connect=open_shimmer, list_candidates=None, interval: float = 15.0,
+                 max_workers: int = 8, handshake_timeout: float = 10.0, query_timeout: float = 5.0):
+        self.storage = storage
+        self.connect = connect
+        self.list_candidates = list_candidates or (lambda: [port.device for port in list_ports.comports()])
+        self.interval = interval
+        self.max_workers = max_workers
+        self.handshake_timeout = handshake_timeout
+        self.query_timeout = query_timeout
+
+        self.lock = threading.Lock()
+        self.warm = {}  # com port -> WarmDevice
+        self.busy = set()  # ports handed over to a ShimmerDevice, not probed until released
+        self.failed = {}  # com port -> last error
+
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.process_lock = None
+
+    def start(self):
+        try:
+            self.process_lock = shared_memory.SharedMemory(name=DISCOVERY_LOCK, create=True, size=8)
+        except FileExistsError:
+            print("Device discovery already runs in another process, connecting to devices on demand")
+            return self
+        self.thread = threading.Thread(target=self.run, name="DeviceDiscovery", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join(timeout=10)
+            self.thread = None
+        with self.lock:
+            devices, self.warm = list(self.warm.values()), {}
+        for device in devices:
+            device.close()
+        if self.process_lock:
+            self.process_lock.close()
+            self.process_lock.unlink()
+            self.process_lock = None
+
+    def run(self):
+        while not self.stop_event.is_set():
+            try:
+                self.scan()
+            except Exception as e:
+                print(f"Device discovery failed. Error: {e}")
+            self.stop_event.wait(self.interval)
+
+    def scan(self):
+        """Probe all new candidate ports and refresh the warm devices, in parallel."""
+        # Ports owned by an acquisition daemon are streaming, probing them would disturb the stream
+        candidates = [port for port in self.list_candidates() if not bus_exists(port)]
+        with self.lock:
+            ports = [port for port in candidates if port not in self.busy]
+            known = dict(self.warm)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="probe") as pool:
+            pool.map(lambda port: self.refresh(known[port]) if port in known else self.probe(port), ports)
+
+        # Devices whose port disappeared, e.g. switched off or unpaired
+        for port in set(known) - set(ports):
+            self.drop(port)
+
+    @staticmethod
+    def handshake(shim_dev):
+        shim_dev.initialize()
+        return shim_dev.get_device_name(), shim_dev.get_battery_state(True), shim_dev.get_sampling_rate()
+
+    def probe(self, com_port):
+        serial = None
+        try:
+            serial, shim_dev = self.connect(com_port)
+            name, battery, sampling_rate = call_with_timeout(self.handshake_timeout, shim_dev.shutdown,
+                                                             self.handshake, shim_dev)
+            shimmer_id = self.storage.register_shimmer(name, com_port, battery)
+        except Exception as e:
+            # Most ports aren't Shimmers, try again on the next scan
+            if serial is not None:
+                serial.close()
+            with self.lock:
+                self.failed[com_port] = str(e)
+            return
+
+        device = WarmDevice(com_port, serial, shim_dev, name, battery, sampling_rate, shimmer_id)
+        with self.lock:
+            self.failed.pop(com_port, None)
+            if com_port in self.busy or com_port in self.warm:
+                device.close()
+                return
+            self.warm[com_port] = device
+        print(f'Found {name} on {com_port}, battery at {battery}%')
+
+    def refresh(self, device: WarmDevice):
+        with self.lock:
+            # Handed over since the scan started
+            if device.com_port in self.busy or self.warm.get(device.com_port) is not device:
+                return
+            device.lock.acquire()
+        try:
+            device.battery = call_with_timeout(self.query_timeout, device.close, device.shim_dev.get_battery_state,
+                                               True)
+            device.checked = time.time()
+        except Exception as e:
+            print(f"Lost {device.name} on {device.com_port}. Error: {e}")
+            self.drop(device.com_port)
+        finally:
+            device.lock.release()
+
+    def drop(self, com_port):
+        with self.lock:
+            device = self.warm.pop(com_port, None)
+        if device:
+            device.close()
+
+    def devices(self):
+        """The warm devices, for a port selector."""
+        with self.lock:
+            return sorted(self.warm.values(), key=lambda device: device.com_port)
+
+    def claim(self, com_port):
+        """Reserve com_port for a ShimmerDevice, False when it already is. The port is skipped until released."""
+        with self.lock:
+            if com_port in self.busy:
+                return False
+            self.busy.add(com_port)
+            return True
+
+    def take(self, com_port):
+        """
+        Hand over the warm device on a claimed com_port, or None when there is none. Raises RuntimeError instead of
+        waiting when discovery is querying the device, it may have gone out of range.
+        """
+        with self.lock:
+            device = self.warm.get(com_port)
+            if device is None:
+                return None
+            if not device.lock.acquire(blocking=False):
+                raise RuntimeError(f"{device.name} on {com_port} is being checked, try again in a moment")
+            del self.warm[com_port]
+        device.lock.release()
+        return device
+
+    def release(self, com_port):
+        with self.lock:
+            self.busy.discard(com_port)
+
+
+class SimulatedShimmer:
+    """
+    Stands in for ShimmerBluetooth on a simulated serial port, with the slow handshake of a real device.
+
+    Out of range it never answers: like pyshimmer, a query then waits until the device is shut down and returns None.
+    """
+
+    def __init__(self, com_port, delay, out_of_range: bool = False):
+        self.com_port = com_port
+        self.delay = delay
+        self.out_of_range = out_of_range
+        self._initialized = False
+        self.shut_down = threading.Event()
+
+    def answer(self, delay):
+        if self.out_of_range:
+            self.shut_down.wait()
+            return False
+        time.sleep(delay)
+        return True
+
+    def initialize(self):
+        self.answer(self.delay)
+        self._initialized = True
+
+    def initialized(self):
+        return self._initialized
+
+    def get_device_name(self):
+        return f"Shimmer-{self.com_port}" if self.answer(self.delay / 4) else None
+
+    def get_battery_state(self, in_percent):
+        return random.randint(20, 100) if self.answer(self.delay / 4) else None
+
+    def get_sampling_rate(self):
+        return 128.0
+
+    def add_stream_callback(self, handler):
+        pass
+
+    def start_streaming(self):
+        pass
+
+    def stop_streaming(self):
+        pass
+
+    def shutdown(self):
+        self.shut_down.set()
+
+
+def simulated_ports(count, delay=1.0, shimmer_every=2, silent=()):
+    """
+    A list_candidates and connect pair for `count` ports, of which every `shimmer_every`th one has a Shimmer. The
+    ports numbered in `silent` open but never answer.
+    """
+    ports = [f"SIM{number}" for number in range(count)]
+
+    def connect(com_port):
+        number = ports.index(com_port)
+        if number in silent:
+            return None, SimulatedShimmer(com_port, delay, out_of_range=True)
+        if number % shimmer_every:
+            # Like a Bluetooth port whose device is out of range, it only fails after a timeout
+            time.sleep(delay)
+            raise OSError(f"Simulated timeout on {com_port}")
+        return None, SimulatedShimmer(com_port, delay)
+
+    return (lambda: ports), connect
+
+
+def simulate(count):
+    path = os.path.join(tempfile.mkdtemp(), 'discovery.db')
+    storage = SqliteStorage(path)
+    # SIM1 opens but never answers
+    list_candidates, connect = simulated_ports(count, silent=(1,))
+    try:
+        for name, workers in (('One port at a time', 1), ('In parallel', 8)):
+            discovery = DeviceDiscovery(storage, connect=connect, list_candidates=list_candidates,
+                                        max_workers=workers, handshake_timeout=3.0)
+            start = time.time()
+            discovery.scan()
+            print(f"{name}: {len(discovery.devices())} of {count} ports have a Shimmer, "
+                  f"scanned in {time.time() - start:.1f}s")
+            discovery.stop()
+        print(f"SIM1: {discovery.failed.get('SIM1')}")
+
+        # Starting on a warm device doesn't wait for the device or the database
+        from shimmer import ShimmerDevice
+        discovery = DeviceDiscovery(storage, connect=connect, list_candidates=list_candidates, handshake_timeout=3.0)
+        discovery.scan()
+        start = time.time()
+        discovery.claim('SIM0')
+        device = ShimmerDevice('SIM0', storage=storage, warm=discovery.take('SIM0'))
+        print(f"Started on {device.dev_name} (shimmer {device.id}) in {(time.time() - start) * 1000:.0f} ms")
+        device.stop_streaming(stop_event=False, upload_data=False)
+        discovery.scan()
+        print(f"SIM0 is skipped while taken: {'SIM0' not in [warm.com_port for warm in discovery.devices()]}")
+        discovery.stop()
+    finally:
+        storage.close()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 2 and sys.argv[1] == '--simulate':
+        simulate(int(sys.argv[2]))
+    else:
+        storage = open_storage()
+        discovery = DeviceDiscovery(storage)
+        discovery.scan()
+        for device in discovery.devices():
+            print(f"{device.com_port}: {device.name}, battery at {device.battery}%, {device.sampling_rate} Hz")
+        for port, error in discovery.failed.items():
+            print(f"{port}: no Shimmer ({error})")
+        discovery.stop()
+        storage.close()
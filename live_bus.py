@@ -0,0 +1,339 @@
+import os
+import threading
+import time
+from datetime import datetime
+from multiprocessing import resource_tracker, shared_memory
+from multiprocessing.connection import AuthenticationError, Client, Listener
+import numpy as np
+import pandas as pd
+
+COLUMNS = ['datetime', 'timestamp', 'gsr_raw', 'ppg_raw', 'gsr']
+
+# Slots of the int64 header in front of the samples, the key of the SessionControl port takes AUTHKEY_SLOTS slots
+SEQ, HEAD, CAPACITY, SHIMMER_ID, SAMPLING_RATE_MHZ, SESSION_ID, CONTROL_PORT, AUTHKEY, HEADER_SIZE = \
+    0, 1, 2, 3, 4, 5, 6, 8, 16
+AUTHKEY_SLOTS = 4
+
+
+def bus_name(com_port):
+    return f"shimmer_{com_port}"
+
+
+def bus_exists(com_port):
+    """Whether an acquisition daemon owns com_port and publishes it on a LiveBus."""
+    try:
+        LiveBus(bus_name(com_port)).close()
+    except FileNotFoundError:
+        return False
+    return True
+
+
+class LiveBus:
+    """
+    Ring buffer of live samples in shared memory, written by the acquisition daemon and read by any number of
+    dashboard processes.
+
+    There is a single writer, which never waits: it bumps the sequence number to odd, writes, and bumps it back
+    to even (a seqlock). Readers copy the rows they want and retry when the sequence number changed underneath them.
+    Datetimes are stored as seconds since 1970 of the naive local datetime, so all columns fit one float64 array.
+    """
+
+    def __init__(self, name, create: bool = False, capacity: int = 65536, shimmer_id: int = 0,
+                 sampling_rate: float = 0.0):
+        row_bytes = len(COLUMNS) * 8
+        if create:
+            self.shm = shared_memory.SharedMemory(name=name, create=True,
+                                                  size=HEADER_SIZE * 8 + capacity * row_bytes)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+            # On posix, attaching registers the segment with this process' resource tracker, which would unlink it
+            # when the dashboard exits while the daemon is still writing
+            if os.name == 'posix':
+                resource_tracker.unregister(self.shm._name, 'shared_memory')
+        self.owner = create
+
+        self.header = np.ndarray((HEADER_SIZE,), dtype=np.int64, buffer=self.shm.buf)
+        if create:
+            self.header[:] = 0
+            self.header[CAPACITY] = capacity
+            self.header[SHIMMER_ID] = shimmer_id
+            self.header[SAMPLING_RATE_MHZ] = round(sampling_rate * 1000)
+        self.capacity = int(self.header[CAPACITY])
+        self.rows = np.ndarray((self.capacity, len(COLUMNS)), dtype=np.float64, buffer=self.shm.buf,
+                               offset=HEADER_SIZE * 8)
+
+    @property
+    def shimmer_id(self):
+        return int(self.header[SHIMMER_ID])
+
+    @property
+    def sampling_rate(self):
+        return self.header[SAMPLING_RATE_MHZ] / 1000
+
+    @property
+    def session_id(self):
+        """The session the daemon is tagging its samples with, 0 is none."""
+        return int(self.header[SESSION_ID])
+
+    @session_id.setter
+    def session_id(self, session_id):
+        self.header[SESSION_ID] = session_id or 0
+
+    @property
+    def control_port(self):
+        return int(self.header[CONTROL_PORT])
+
+    @property
+    def authkey(self):
+        return self.header[AUTHKEY:AUTHKEY + AUTHKEY_SLOTS].tobytes()
+
+    def set_control(self, port, authkey):
+        self.header[AUTHKEY:AUTHKEY + AUTHKEY_SLOTS] = np.frombuffer(authkey, dtype=np.int64)
+        self.header[CONTROL_PORT] = port
+
+    @property
+    def head(self):
+        """Total number of samples ever published."""
+        return int(self.header[HEAD])
+
+    def publish(self, samples: pd.DataFrame):
+        values = np.column_stack([
+            (pd.to_datetime(samples['datetime']) - pd.Timestamp(0)) / pd.Timedelta(seconds=1),
+            samples['timestamp'].to_numpy(dtype=np.float64),
+            samples['gsr_raw'].to_numpy(dtype=np.float64),
+            samples['ppg_raw'].to_numpy(dtype=np.float64),
+            samples['gsr'].to_numpy(dtype=np.float64),
+        ])[-self.capacity:]
+        head = int(self.header[HEAD])
+        positions = (head + np.arange(len(values))) % self.capacity
+
+        self.header[SEQ] += 1
+        self.rows[positions] = values
+        self.header[HEAD] = head + len(values)
+        self.header[SEQ] += 1
+
+    def read_values(self, position: int, end: int = None, limit: int = None, timeout: float = 1.0):
+        """
+        Raw rows published after `position` (a previous head) up to `end` (the current head by default), and the
+        head they end at.
+
+        When the reader fell more than a whole buffer behind, the oldest samples are gone and only the last
+        `capacity` are returned. A write takes microseconds, so when one seems to be going on for `timeout` seconds
+        the writer died halfway and TimeoutError is raised.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            seq = int(self.header[SEQ])
+            if seq % 2:
+                if time.monotonic() > deadline:
+                    raise TimeoutError("The LiveBus writer stopped in the middle of a write")
+                time.sleep(0)
+                continue
+
+            head = int(self.header[HEAD])
+            stop = head if end is None else min(end, head)
+            start = min(max(position, head - self.capacity), stop)
+            if limit is not None:
+                start = max(start, stop - limit)
+            values = self.rows[np.arange(start, stop) % self.capacity]  # fancy indexing copies
+
+            if int(self.header[SEQ]) == seq:
+                return values, stop
+
+    def read_since(self, position: int, limit: int = None):
+        """Samples published after `position` as a DataFrame, and the new head to pass next time."""
+        values, head = self.read_values(position, limit=limit)
+        data = pd.DataFrame(values, columns=COLUMNS)
+        data['datetime'] = pd.to_datetime(data['datetime'], unit='s')
+        for column in ['timestamp', 'gsr_raw', 'ppg_raw']:
+            data[column] = data[column].astype(np.int64)
+        return data, head
+
+    def read_latest(self, count: int):
+        return self.read_since(0, limit=count)[0]
+
+    def close(self):
+        self.header = self.rows = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+class SessionControl:
+    """
+    Runs the sessions of the acquisition daemon for the dashboards following its LiveBus.
+
+    The session is created in the daemon's own storage, the one its samples are tagged and uploaded with, so the
+    session and its samples always end up in the same database. Dashboards connect to a local port published in the
+    bus header, together with the key, and send start, event and stop requests. Only the dashboard that started a
+    session can add events to it or stop it.
+
+    A dashboard that goes away without stopping its session would block every later start. So the session is
+    stopped when its connection drops (the dashboard process ended) or when the dashboard hasn't sent anything for
+    `timeout` seconds (its tab was closed), at the last time it was heard from.
+    """
+
+    def __init__(self, device, bus: LiveBus, timeout: float = 30.0):
+        self.device = device
+        self.bus = bus
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.owner = None  # connection of the dashboard running the session
+        self.last_seen = None  # time.time() of the owner's last request
+        self.listener = None
+
+    def start(self):
+        authkey = os.urandom(AUTHKEY_SLOTS * 8)
+        self.listener = Listener(('127.0.0.1', 0), authkey=authkey)
+        self.bus.set_control(self.listener.address[1], authkey)
+        threading.Thread(target=self.accept, name="SessionControl", daemon=True).start()
+        return self
+
+    def accept(self):
+        while True:
+            try:
+                connection = self.listener.accept()
+            except AuthenticationError:
+                continue
+            except OSError:
+                # Closed
+                return
+            threading.Thread(target=self.serve, args=(connection,), daemon=True).start()
+
+    def serve(self, connection):
+        with connection:
+            while True:
+                try:
+                    command, *args = connection.recv()
+                except (EOFError, OSError):
+                    self.disconnected(connection)
+                    return
+                try:
+                    reply = ('ok', self.handle(connection, command, args))
+                except Exception as e:
+                    reply = ('error', str(e))
+                try:
+                    connection.send(reply)
+                except OSError:
+                    self.disconnected(connection)
+                    return
+
+    def handle(self, connection, command, args):
+        with self.lock:
+            if command == 'start':
+                if self.device.session:
+                    raise RuntimeError(f"Session {self.device.session.id} is already running on this device")
+                session = self.device.start_session(*args)
+                self.owner = connection
+                self.last_seen = time.time()
+                self.bus.session_id = session.id
+                return session.id
+
+            if self.device.session is None or connection is not self.owner:
+                raise RuntimeError("This dashboard isn't running a session on this device")
+            self.last_seen = time.time()
+            if command == 'heartbeat':
+                pass
+            elif command == 'event':
+                self.device.session.add_event(*args)
+            elif command == 'stop':
+                self.stop_session(*args)
+            else:
+                raise ValueError(f"Unknown request: {command}")
+
+    def disconnected(self, connection):
+        with self.lock:
+            if connection is self.owner:
+                print(f"The dashboard running session {self.device.session.id} disconnected, stopping it")
+                self.stop_session()
+
+    def check(self):
+        """Stop the session when its dashboard has been silent for too long, called regularly by the daemon."""
+        with self.lock:
+            if self.owner is not None and time.time() - self.last_seen > self.timeout:
+                print(f"No word from the dashboard running session {self.device.session.id} for {self.timeout:.0f}s, "
+                      f"stopping it")
+                self.stop_session(datetime.fromtimestamp(self.last_seen))
+
+    def stop_session(self, when=None):
+        self.owner = None
+        self.bus.session_id = None
+        self.device.stop_session(when)
+
+    def close(self):
+        if self.listener:
+            self.listener.close()
+            self.listener = None
+
+
+class DaemonSession:
+    """Stands in for Session in the dashboard, the session itself runs in the acquisition daemon."""
+
+    def __init__(self, device, session_id):
+        self.device = device
+        self.id = session_id
+
+    def add_event(self, event, note=None, when=None):
+        self.device.request('event', event, note, when or datetime.now())
+
+    def ping(self, note=None, when=None):
+        self.add_event('ping', note, when)
+
+
+class LiveBusDevice:
+    """Stands in for ShimmerDevice in the dashboard when the acquisition daemon owns the device."""
+
+    def __init__(self, com_port, window: int = 1000):
+        self.bus = LiveBus(bus_name(com_port))
+        self.com_port = com_port
+        self.window = window
+        self.id = self.bus.shimmer_id
+        self.sampling_rate = self.bus.sampling_rate
+        self.session = None
+        self.control = None  # connection to the daemon's SessionControl, opened on the first request
+        self.lock = threading.Lock()
+
+    def request(self, command, *args):
+        with self.lock:
+            try:
+                if self.control is None:
+                    self.control = Client(('127.0.0.1', self.bus.control_port), authkey=self.bus.authkey)
+                self.control.send((command,) + args)
+                status, value = self.control.recv()
+            except (EOFError, OSError) as e:
+                self.control = None
+                raise RuntimeError(f"Can't reach the acquisition daemon: {e}")
+        if status == 'error':
+            raise RuntimeError(value)
+        return value
+
+    def get_live_data(self):
+        if self.session:
+            # Tells the daemon this dashboard is still there, see SessionControl
+            try:
+                self.request('heartbeat')
+            except RuntimeError as e:
+                print(f"Session {self.session.id} on {self.com_port} was stopped by the daemon. Error: {e}")
+                self.session = None
+        return self.bus.read_latest(self.window)
+
+    def start_streaming(self):
+        # The daemon streams all the time
+        pass
+
+    def start_session(self, player_id, game):
+        self.session = DaemonSession(self, self.request('start', int(player_id), game))
+        return self.session
+
+    def stop_streaming(self, stop_event: bool = True, upload_data: bool = True):
+        # The daemon already uploads every sample as it comes in
+        if stop_event and self.session:
+            try:
+                self.request('stop')
+            except RuntimeError as e:
+                print(f"Failed to stop session {self.session.id}. Error: {e}")
+        self.session = None
+        if self.control is not None:
+            self.control.close()
+            self.control = None
+        self.bus.close()
@@ -0,0 +1,314 @@
+import asyncio
+import json
+import socket
+import sys
+import threading
+import time
+from datetime import datetime
+import numpy as np
+import pandas as pd
+from live_bus import COLUMNS, LiveBus, bus_name
+
+# Server-sent events feed of the live samples on the LiveBus, for tablets and other clients without Python.
+# Usage: python live_feed.py COM3 [COM4 ...]      serve the buses of running acquisition daemons
+#        python live_feed.py --simulate 60          load test with a synthetic device and 60 clients
+
+# LiveBus datetimes are naive local time
+EPOCH = datetime(1970, 1, 1)
+
+PAGE = """<!DOCTYPE html>
+<html><head><meta name="viewport" content="width=device-width"><title>PSV live</title></head>
+<body style="font-family: sans-serif">
+<h3 id="title">Waiting for data</h3><canvas id="chart" width="900" height="300"></canvas>
+<script>
+const port = new URLSearchParams(location.search).get("port") || "%s";
+const gsr = [];
+const source = new EventSource("/events/" + port);
+source.onmessage = (message) => {
+  const frame = JSON.parse(message.data);
+  let value = 0;
+  for (const step of frame.gsr) { value += step; gsr.push(value / 1000); }
+  gsr.splice(0, Math.max(0, gsr.length - 1000));
+  document.getElementById("title").textContent =
+    port + ": GSR " + frame.metrics.gsr_mean.toFixed(2) + " uS, " + frame.metrics.rate.toFixed(0) + " Hz";
+  const canvas = document.getElementById("chart"), ctx = canvas.getContext("2d");
+  const low = Math.min(...gsr), high = Math.max(...gsr) || 1;
+  ctx.clearRect(0, 0, canvas.width, canvas.height);
+  ctx.beginPath();
+  gsr.forEach((y, x) => ctx.lineTo(x * canvas.width / 1000,
+    canvas.height - (y - low) / (high - low || 1) * canvas.height));
+  ctx.stroke();
+};
+</script></body></html>
+"""
+
+
+def encode_frame(values: np.ndarray, head: int, metrics: dict):
+    """
+    One SSE message with LiveBus rows delta encoded: every list holds the first value followed by the differences,
+    which are mostly small numbers. Datetimes are in milliseconds and GSR in thousandths of a microsiemens.
+    """
+    columns = {
+        'datetime': np.rint(values[:, COLUMNS.index('datetime')] * 1000),
+        'gsr_raw': values[:, COLUMNS.index('gsr_raw')],
+        'ppg_raw': values[:, COLUMNS.index('ppg_raw')],
+        'gsr': np.rint(values[:, COLUMNS.index('gsr')] * 1000),
+    }
+    frame = {name: np.diff(column.astype(np.int64), prepend=0).tolist() for name, column in columns.items()}
+    frame['head'] = head
+    frame['metrics'] = metrics
+    return f"data: {json.dumps(frame, separators=(',', ':'))}\n\n".encode()
+
+
+class LiveFeedServer:
+    """
+    Pushes the samples of one or more LiveBuses to any number of HTTP clients as server-sent events.
+
+    A single poller per bus checks for new samples and computes the derived metrics once for everyone. Every
+    client runs in its own task and always sends everything since its own last position as a single frame, so a
+    slow client (its socket buffer is full and drain() blocks) automatically gets fewer, larger frames instead of a
+    growing queue. Clients that fall more than max_batch samples behind skip ahead to the latest data. Clients that
+    are at the same position share one encoded frame.
+    """
+
+    def __init__(self, ports, interval: float = 0.1, max_batch: int = 2048, metrics_window: float = 10.0,
+                 reattach_after: float = 2.0):
+        self.ports = list(ports)
+        self.interval = interval
+        self.max_batch = max_batch
+        self.metrics_window = metrics_window
+        self.reattach_after = reattach_after
+
+        self.buses = {}
+        self.metrics = {}
+        self.heads = {}
+        self.last_change = {}  # port -> monotonic time the head last moved or the bus was (re)attached
+        self.frames = {}  # (port, start, head) -> encoded frame, only for the latest head
+        self.updated = None
+        self.clients = 0
+        self.port = None  # the TCP port served on, once serving
+
+    def attach(self, port):
+        """
+        The bus of `port`, or None while its acquisition daemon isn't running. A bus that hasn't moved for a while
+        is opened again, so a restarted daemon (which creates a new segment under the same name) is picked up.
+        """
+        bus = self.buses.get(port)
+        if bus is not None and time.monotonic() - self.last_change.get(port, 0) < self.reattach_after:
+            return bus
+        try:
+            new_bus = LiveBus(bus_name(port))
+        except FileNotFoundError:
+            return bus
+        if bus is not None and not bus.owner:
+            bus.close()
+        self.buses[port] = new_bus
+        self.last_change[port] = time.monotonic()
+        return new_bus
+
+    async def poll(self):
+        while True:
+            changed = False
+            for port in self.ports:
+                bus = self.attach(port)
+                if bus is None:
+                    continue
+                try:
+                    if bus.head != self.heads.get(port):
+                        self.heads[port] = bus.head
+                        self.last_change[port] = time.monotonic()
+                        self.metrics[port] = self.compute_metrics(bus)
+                        self.frames = {key: frame for key, frame in self.frames.items() if key[0] != port}
+                        changed = True
+                except TimeoutError as e:
+                    # The daemon died while writing, wait for it to be restarted
+                    print(f"{port}: {e}")
+            if changed:
+                async with self.updated:
+                    self.updated.notify_all()
+            await asyncio.sleep(self.interval)
+
+    def compute_metrics(self, bus):
+        rate = bus.sampling_rate or 1.0
+        recent = bus.read_latest(int(rate * self.metrics_window))
+        if recent.empty:
+            return {'gsr_mean': 0.0, 'rate': 0.0, 'clients': self.clients}
+        span = (recent['datetime'].iloc[-1] - recent['datetime'].iloc[0]).total_seconds()
+        return {
+            'gsr_mean': round(float(recent['gsr'].mean()), 3),
+            'rate': round((len(recent) - 1) / span, 1) if span > 0 else 0.0,
+            'clients': self.clients,
+        }
+
+    async def handle(self, reader, writer):
+        try:
+            request = await reader.readline()
+            # Skip the request headers
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+            parts = request.decode(errors='replace').split()
+            path = parts[1] if len(parts) > 1 else '/'
+
+            if path.startswith('/events/') and path[len('/events/'):] in self.buses:
+                await self.stream(path[len('/events/'):], writer)
+            elif path.startswith('/events/') and path[len('/events/'):] in self.ports:
+                # The acquisition daemon for this port hasn't started yet, EventSource retries by itself
+                writer.write(b"HTTP/1.1 503 Service Unavailable\r\nRetry-After: 5\r\nContent-Length: 0\r\n"
+                             b"Connection: close\r\n\r\n")
+                await writer.drain()
+            elif path == '/' or path.startswith('/?'):
+                body = (PAGE % self.ports[0]).encode()
+                writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/html; charset=utf-8\r\n"
+                             + f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+                await writer.drain()
+            else:
+                writer.write(b"HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, TimeoutError):
+            pass
+        finally:
+            writer.close()
+
+    async def stream(self, port, writer):
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\n"
+                     b"Access-Control-Allow-Origin: *\r\nConnection: keep-alive\r\n\r\n")
+        # Keep the buffers small so a slow client pushes back quickly instead of queueing seconds of data
+        writer.transport.set_write_buffer_limits(high=4096)
+        writer.get_extra_info('socket').setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 16 * 1024)
+
+        position = max(0, self.heads.get(port, 0) - self.max_batch)
+        self.clients += 1
+        try:
+            while True:
+                # Everything up to the head the poller last saw, so clients at the same position share the frame
+                head = self.heads.get(port, 0)
+                if head < position:
+                    # The daemon restarted and its head started over
+                    position = 0
+                start = max(position, head - self.max_batch)
+                if start < head:
+                    if (port, start, head) not in self.frames:
+                        values, head = self.buses[port].read_values(start, end=head)
+                        self.frames[(port, start, head)] = encode_frame(values, head, self.metrics.get(port, {}))
+                    writer.write(self.frames[(port, start, head)])
+                    await writer.drain()
+                position = head
+
+                async with self.updated:
+                    await self.updated.wait_for(lambda: self.heads.get(port, 0) != position)
+        finally:
+            self.clients -= 1
+
+    async def serve(self, host='0.0.0.0', port=8765):
+        """Serve until cancelled, port 0 picks a free port."""
+        self.updated = asyncio.Condition()
+        server = await asyncio.start_server(self.handle, host, port)
+        self.port = server.sockets[0].getsockname()[1]
+        print(f"Serving live feed of {', '.join(self.ports)} on http://{host}:{self.port}/")
+        async with server:
+            await asyncio.gather(server.serve_forever(), self.poll())
+
+
+def simulate_device(port, rate=128.0, stop=None):
+    """Publish a synthetic signal on a LiveBus, like shimmer_run.py does for a real device."""
+    bus = LiveBus(bus_name(port), create=True, shimmer_id=0, sampling_rate=rate)
+    tick = 0
+    start = time.time()
+
+    def run():
+        nonlocal tick
+        while not stop.is_set():
+            count = int((time.time() - start) * rate) - tick
+            if count > 0:
+                index = tick + np.arange(count)
+                bus.publish(pd.DataFrame({
+                    'datetime': pd.Timestamp.now() + pd.to_timedelta((index - index[-1]) / rate, unit='s'),
+                    'timestamp': index * int(32768 / rate),
+                    'gsr_raw': 2000 + (200 * np.sin(index / rate)).astype(np.int64),
+                    'ppg_raw': 1500 + (300 * np.sin(index / rate * 2 * np.pi * 1.2)).astype(np.int64),
+                    'gsr': 5 + np.sin(index / rate),
+                }))
+                tick += count
+            time.sleep(0.02)
+        bus.close()
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread, bus
+
+
+async def simulate_clients(count, server_port, duration, slow_every=5, port='SIM', delay=0.0):
+    """
+    Connect `count` clients to the feed of `port` after `delay` seconds, every `slow_every`th one reading slowly.
+    Returns (frames, samples, max latency in seconds, newest sample as seconds since 1970) per client, the newest
+    sample in naive local time like the LiveBus.
+    """
+
+    async def client(number):
+        slow = number % slow_every == 0
+        await asyncio.sleep(delay)
+        reader, writer = await asyncio.open_connection('127.0.0.1', server_port)
+        if slow:
+            # A slow connection: a small receive window, drained in bursts twice a second
+            writer.get_extra_info('socket').setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        writer.write(f"GET /events/{port} HTTP/1.1\r\nHost: localhost\r\n\r\n".encode())
+        frames = samples = 0
+        latency = newest = 0.0
+        buffer = b''
+        deadline = time.time() + duration
+        while time.time() < deadline:
+            try:
+                chunk = await asyncio.wait_for(reader.read(512 if slow else 65536),
+                                               timeout=max(0.01, deadline - time.time()))
+            except asyncio.TimeoutError:
+                break
+            if not chunk:
+                break
+            *messages, buffer = (buffer + chunk).split(b'\n\n')
+            for message in messages:
+                if b'data: ' in message:
+                    frame = json.loads(message[message.index(b'data: ') + 6:])
+                    frames += 1
+                    samples += len(frame['gsr'])
+                    newest = np.sum(frame['datetime']) / 1000
+                    latency = max(latency, (datetime.now() - EPOCH).total_seconds() - newest)
+            if slow:
+                await asyncio.sleep(0.5)
+        writer.close()
+        return frames, samples, latency, newest
+
+    return await asyncio.gather(*(client(number) for number in range(count)))
+
+
+def report(results, slow_every=5):
+    slow = [result for number, result in enumerate(results) if number % slow_every == 0]
+    fast = [result for number, result in enumerate(results) if number % slow_every != 0]
+    for name, group in (('fast', fast), ('slow', slow)):
+        if group:
+            print(f"{len(group)} {name} clients: {np.mean([r[0] for r in group]):.0f} frames, "
+                  f"{np.mean([r[1] for r in group]):.0f} samples, max latency {max(r[2] for r in group):.2f}s")
+
+
+async def run_simulation(count, duration=10.0, server_port=8765):
+    stop = threading.Event()
+    device, bus = simulate_device('SIM', stop=stop)
+    server = LiveFeedServer(['SIM'])
+    server.buses['SIM'] = bus
+    server.last_change['SIM'] = time.monotonic()
+    serving = asyncio.create_task(server.serve('127.0.0.1', server_port))
+    await asyncio.sleep(0.5)
+    try:
+        report(await simulate_clients(count, server_port, duration))
+        # Let the server notice the closed connections before shutting down
+        await asyncio.sleep(1.0)
+    finally:
+        serving.cancel()
+        stop.set()
+        device.join()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 2 and sys.argv[1] == '--simulate':
+        asyncio.run(run_simulation(int(sys.argv[2])))
+    else:
+        asyncio.run(LiveFeedServer(sys.argv[1:] or ['COM3']).serve())
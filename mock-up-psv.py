@@ -1,7 +1,4 @@
 import sys
-import pyodbc
-import config
-import time
 import atexit
 import streamlit as st
 import pandas as pd
@@ -9,7 +6,15 @@ import numpy as np
 import altair as alt
 import neurokit2 as nk
 import shimmer
+from datetime import datetime, timedelta
 from shimmer import ShimmerDevice
+from discovery import DeviceDiscovery
+from live_bus import LiveBusDevice
+from render_scheduler import RenderScheduler
+from sensor_cache import RecentSensorCache
+from storage import open_storage, open_store_and_forward
+from sampling import estimate_sampling_rate, ppg_intervals, resample_uniform
+from signal_quality import GSR_BAD, PPG_BAD
 
 # Config of variables
 fake_fallback = False
@@ -21,190 +26,114 @@ else:
     com_port = "COM8"  # Default value if no input is provided
 
 
-def get_db_connection():
+# One storage for all sessions, so store-and-forward runs a single sync agent
+@st.cache_resource
+def get_storage():
     try:
-        conn = pyodbc.connect(
-            f"DRIVER={{ODBC Driver 17 for SQL Server}};"
-            f"SERVER={config.server_host};"
-            f"DATABASE=PSV;"
-            f"UID=team;"
-            f"PWD={config.password}"
-        )
-        return conn
-    except pyodbc.Error as e:
-        st.error(f"Database connection failed: {e}")
-        st.stop()
+        return open_storage()
+    except Exception as e:
+        print(f"Database connection failed: {e}")
+        print("Falling back to local storage with store-and-forward sync")
+        return open_store_and_forward()
+
+
+# Keeps the paired Shimmers connected and registered in the background, so Start only has to hand one over
+@st.cache_resource
+def get_discovery():
+    return DeviceDiscovery(get_storage()).start()
+
+
+def open_device(com_port, storage):
+    # Follow the acquisition daemon (shimmer_run.py) when it owns the port, so reruns and other tabs never open it twice
+    try:
+        return LiveBusDevice(com_port)
+    except FileNotFoundError:
+        pass
+
+    # Without a warm device on this port, ShimmerDevice connects the slow way
+    discovery = get_discovery()
+    if not discovery.claim(com_port):
+        raise RuntimeError(f"{com_port} is already streaming in another tab")
+    try:
+        return ShimmerDevice(com_port, fake_fallback, storage=storage, warm=discovery.take(com_port))
+    except Exception:
+        discovery.release(com_port)
+        raise
 
 
 def stop_stream():
     if st.session_state.device is not None:
         st.session_state.device.stop_streaming()
+        # Only ShimmerDevices claimed their port, the daemon owns it for a LiveBusDevice
+        if isinstance(st.session_state.device, ShimmerDevice):
+            get_discovery().release(st.session_state.device.com_port)
         st.session_state.device = None
         st.toast('Shimmer disconnected', icon="🔌")
 
 
-def fetch_player_data(conn):
-    qry = "SELECT * FROM dbo.player"
-    player_dt = pd.read_sql(qry, conn)
-    return player_dt
-
-
-def fetch_sensor_data(conn):
-    query = "SELECT * FROM dbo.sensor_data"
-    sensor_data = pd.read_sql(query, conn)
-    sensor_data['gsr'] = sensor_data['gsr_raw'].apply(shimmer.convert_ADC_to_GSR)
-    return sensor_data
-
-
-def fetch_recent_sensor_data(conn):
-    query = """
-    SELECT * FROM dbo.sensor_data
-    WHERE datetime >= DATEADD(day, -7, GETDATE())
-    """
-    sensor_data = pd.read_sql(query, conn)
-    sensor_data['gsr'] = sensor_data['gsr_raw'].apply(shimmer.convert_ADC_to_GSR)
-    return sensor_data
-
-
-# Fetch measurement data from the database
-def fetch_measurement_data(conn):
-    query = "SELECT * FROM dbo.measurement"
-    measurement_data = pd.read_sql(query, conn)
-    return measurement_data
-
-
-# Fetch shimmer data from the database
-def fetch_shimmer_data(conn):
-    query = "SELECT * FROM dbo.shimmer"
-    shimmer_data = pd.read_sql(query, conn)
-    return shimmer_data
-
-
-def fetch_measurement_ranges(conn):
-    query = """
-    WITH StartGame AS (
-        SELECT
-            player_id,
-            shimmer_id,
-            datetime AS start_time,
-            note AS game,
-            ROW_NUMBER() OVER (PARTITION BY player_id, shimmer_id ORDER BY datetime DESC) AS row_num
-        FROM dbo.measurement
-        WHERE event = 'start_game'
-    ),
-    StopGame AS (
-        SELECT
-            player_id,
-            shimmer_id,
-            datetime AS end_time,
-            ROW_NUMBER() OVER (PARTITION BY player_id, shimmer_id ORDER BY datetime DESC) AS row_num
-        FROM dbo.measurement
-        WHERE event = 'stop_game'
-    ),
-    MeasurementPairs AS (
-        SELECT
-            sg.player_id,
-            sg.shimmer_id,
-            sg.start_time,
-            st.end_time,
-            sg.game
-        FROM StartGame sg
-        INNER JOIN StopGame st ON sg.player_id = st.player_id AND sg.shimmer_id = st.shimmer_id AND sg.row_num = st.row_num
-        WHERE sg.start_time < st.end_time
-    )
-    SELECT
-        player_id,
-        shimmer_id,
-        start_time,
-        end_time,
-        game
-    FROM MeasurementPairs
-    ORDER BY start_time DESC;
-    """
-
-    # query = """
-    # WITH DataWithPreviousTime AS (
-    #     SELECT *,
-    #            LAG(datetime) OVER (ORDER BY datetime) AS PreviousTime
-    #     FROM dbo.sensor_data
-    # ),
-    # DataWithStreamId AS (
-    #     SELECT *,
-    #            SUM(IIF(DATEDIFF(SECOND, PreviousTime, datetime) > 1, 1, 0)) OVER (ORDER BY datetime) AS StreamId
-    #     FROM DataWithPreviousTime
-    # ),
-    # StreamDetails AS (
-    #     SELECT StreamId,
-    #            MIN(datetime) AS start_time,
-    #            MAX(datetime) AS end_time
-    #     FROM DataWithStreamId
-    #     GROUP BY StreamId
-    # )
-    # SELECT
-    #     start_time,
-    #     end_time
-    # FROM StreamDetails
-    # ORDER BY start_time DESC;
-    # """
-    measurement_ranges = pd.read_sql(query, conn)
-    return measurement_ranges
-
-
-def fetch_filtered_sensor_data(conn, start_time, end_time, shimmer_id):
-    query = """
-    SELECT * FROM dbo.sensor_data
-    WHERE datetime >= ? AND datetime <= ? AND shimmer_id = ?
-    """
-    params = (start_time, end_time, int(shimmer_id))
-    filtered_data = pd.read_sql(query, conn, params=params)
-    return filtered_data
-
-
-def send_event(conn, event, note=""):
-    # Check if player id and device id are set to prevent errors
-    if "selected_player_id" not in st.session_state or "device" not in st.session_state:
+# Shared between all sessions and reruns, so every refresh only fetches rows newer than the watermark
+@st.cache_resource
+def get_recent_sensor_cache():
+    return RecentSensorCache(window=timedelta(days=7))
+
+
+def fetch_session_data(storage, session):
+    # Sessions within the window are served from the local copy, older ones straight from the database. Only the
+    # session's shimmer is brought up to date, the others are fetched when one of their sessions is viewed
+    cache = get_recent_sensor_cache()
+    if session['start_time'] < datetime.now() - cache.window:
+        return storage.fetch_session_samples(session['session_id'])
+
+    cache.refresh(storage, [session['shimmer_id']])
+    data = cache.get(session['shimmer_id'])
+    return data[data['session_id'] == session['session_id']].reset_index(drop=True)
+
+
+# Shared by all tabs, so the frame rate adapts to how many of them follow a stream
+@st.cache_resource
+def get_render_scheduler():
+    return RenderScheduler()
+
+
+# Built and validated once, every frame only passes new data for the named datasets.
+# cache_data hands out a copy, st.vega_lite_chart consumes the datasets key of the spec it gets.
+@st.cache_data
+def live_chart_spec(name):
+    live = alt.Data(name='live')
+    column = {'GSR': 'gsr', 'GSR raw': 'gsr_raw', 'PPG': 'ppg_raw'}[name]
+    chart = alt.Chart(live).transform_fold(
+        [column],
+        as_=['Measurement', 'value']
+    ).mark_line().encode(
+        x=alt.X('datetime:T', axis=alt.Axis(title='Datetime')),
+        y=alt.Y('value:Q', scale=alt.Scale(nice=True)),
+        color='Measurement:N'
+    ).interactive()
+
+    if name == 'GSR':
+        # Annotations move with the data
+        annotation_layer = (
+            alt.Chart(alt.Data(name='annotations'))
+            .mark_text(size=25, text="⬇️", dx=0, dy=0, align="center")
+            .encode(x=alt.X("datetime:T", axis=None), y=alt.Y("y:Q"), tooltip=["value:N"])
+        )
+        chart = chart + annotation_layer
+    return chart.to_dict()
+
+
+def send_event(event, note=""):
+    # Check if a session is running to prevent errors
+    if st.session_state.device is None or st.session_state.device.session is None:
         st.error("Player or device not selected")
         return
 
     try:
-        with conn.cursor() as cursor:
-            cursor.execute("""
-                INSERT INTO measurement (player_id, shimmer_id, event, note)
-                VALUES (?, ?, ?, ?)
-            """, (st.session_state.selected_player_id, st.session_state.device.id, event, note))
-
-            conn.commit()
+        # Queued on the session and written with the next batch
+        st.session_state.device.session.add_event(event, note)
     except Exception as e:
         st.error(f"Failed to send event to database: {e}")
 
 
-def fetch_training_types(conn):
-    query = """
-    WITH CTE AS (
-        SELECT note,
-               -- Add a column for sorting purposes
-               IIF(note = 'None', 1, 0) AS SortOrder
-        FROM dbo.measurement
-        WHERE event = 'start_game'
-    )
-    SELECT DISTINCT note AS training_type, SortOrder
-    FROM CTE
-    ORDER BY SortOrder, note
-    """
-    games = pd.read_sql(query, conn)
-    return games['training_type'].tolist()
-
-
-def fetch_ping_events(conn, shimmer_id, start_time, end_time):
-    query = """
-    SELECT datetime, note FROM dbo.measurement
-    WHERE event = 'ping' AND shimmer_id = ? AND datetime >= ? AND datetime <= ?
-    """
-    params = (int(shimmer_id), start_time, end_time)
-    ping_events = pd.read_sql(query, conn, params=params)
-    return ping_events
-
-
 atexit.register(stop_stream)
 
 # Initialize or update session state
@@ -215,7 +144,7 @@ if "device" not in st.session_state:
     st.session_state.device = None
 
 if "line_chart_data" not in st.session_state:
-    st.session_state.line_chart_data = pd.DataFrame(columns=["datetime", "gsr", "ppg_raw"])
+    st.session_state.line_chart_data = pd.DataFrame(columns=["datetime", "gsr", "gsr_raw", "ppg_raw"])
 
 if "annotations_df" not in st.session_state:
     st.session_state.annotations_df = pd.DataFrame(columns=["datetime", "value", "y"])
@@ -246,9 +175,16 @@ tab1, tab2 = st.tabs(["Live monitoring", "Historical data"])
 current_tab = st.query_params.get("tab", ["Live monitoring"])[0]
 
 # Create a connection to the database
-conn = get_db_connection()
+storage = get_storage()
+
+if getattr(storage, 'sync_agent', None):
+    sync_status = storage.sync_agent.status()
+    if not sync_status['online'] or sync_status['pending_samples']:
+        st.caption(f"Central database {'online' if sync_status['online'] else 'offline'}: "
+                   f"{sync_status['pending_samples']} samples waiting to sync, "
+                   f"{sync_status['lag_seconds']:.0f}s behind")
 
-player_data = fetch_player_data(conn)
+player_data = storage.fetch_players()
 
 # Create a dictionary mapping player names to their IDs
 player_dict = dict(zip(player_data['name'], player_data['id']))
@@ -259,6 +195,14 @@ with tab1:
         col1, col2 = st.columns(2, gap="large")
         with col1:
             game = st.selectbox('Game', ("Aristotle", "MoveSense", "Stack Tower"), index=None, key='game')
+
+            # Ports with a Shimmer found by discovery, and the one given on the command line
+            warm_devices = {device.com_port: device for device in get_discovery().devices()}
+            ports = sorted(set(warm_devices) | {com_port})
+            st.selectbox('Device', ports, index=ports.index(com_port), key='com_port',
+                         format_func=lambda port: f"{port}: {warm_devices[port].name}, "
+                                                  f"battery {warm_devices[port].battery}%"
+                         if port in warm_devices else port)
         with col2:
             selected_player_name = st.selectbox('Player', options=list(player_dict.keys()), index=None, key='player')
             submit_button = st.form_submit_button("Start", on_click=lambda: setattr(st.session_state, 'disabled', True),
@@ -267,21 +211,28 @@ with tab1:
     if submit_button or st.session_state.disabled:
         if st.session_state.device is None:
             # Start streaming
-            st.session_state.device = ShimmerDevice(com_port, fake_fallback)
+            try:
+                st.session_state.device = open_device(st.session_state.com_port, storage)
+            except RuntimeError as e:
+                st.session_state.disabled = False
+                st.error(f"Can't connect: {e}")
+                st.stop()
             st.session_state.device.start_streaming()
             st.toast('Shimmer connected', icon="🎉")
 
-            # Put the chosen game and player in the database
+            # Start a session for the chosen game and player, its samples are tagged with the session id
             st.session_state.selected_game = st.session_state.game
             st.session_state.selected_player = st.session_state.player
             st.session_state.selected_player_id = player_dict[st.session_state.player]
 
-            query = f"""
-             INSERT INTO measurement (player_id, shimmer_id, event, note)
-             VALUES ({st.session_state.selected_player_id}, {st.session_state.device.id}, 'start_game', '{st.session_state.selected_game}')
-             """
-            conn.cursor().execute(query)
-            conn.commit()
+            try:
+                st.session_state.device.start_session(st.session_state.selected_player_id,
+                                                      st.session_state.selected_game)
+            except RuntimeError as e:
+                stop_stream()
+                st.session_state.disabled = False
+                st.error(f"Can't start a session: {e}")
+                st.stop()
 
         # Ping form
         with st.form('ping_form', clear_on_submit=True):
@@ -296,89 +247,73 @@ with tab1:
             })
             st.session_state.annotations_df = pd.concat([st.session_state.annotations_df, new_annotation],
                                                         ignore_index=True)
-            send_event(conn, 'ping', ping_text)
+            send_event('ping', ping_text)
 
             st.toast('Ping sent', icon="🎉")
 
         colu1, colu2, colu3 = st.columns([1, 1, 0.2])
+        with colu1:
+            # Only the selected charts are built and drawn
+            visible_charts = st.multiselect('Charts', ['GSR', 'GSR raw', 'PPG'], default=['GSR'])
         with colu3:
             stop_button = st.button('Stop streaming', type="primary")
 
         placeholder = st.empty()
-        # Continuous data generation loop
-        while True:
-            # Append livestreamed values to DataFrame
-            live_data = st.session_state.device.get_live_data()
-
-            st.session_state.line_chart_data = pd.concat(
-                [st.session_state.line_chart_data, live_data]).drop_duplicates().reset_index(drop=True)
-
-            # Keep only the last 80 datapoints, to create scrolling window effect
-            st.session_state.line_chart_data = st.session_state.line_chart_data.tail(40)
-
-            # Ensure annotations are in sync with the live data
-            annotations_data_tail = st.session_state.annotations_df[
-                st.session_state.annotations_df['datetime'] >= st.session_state.line_chart_data['datetime'].min()]
-
-            # Build the GSR line chart
-            gsr_chart = alt.Chart(st.session_state.line_chart_data).transform_fold(
-                ["gsr"],
-                as_=['Measurement', 'value']
-            ).mark_line().encode(
-                x=alt.X('datetime:T', axis=alt.Axis(title='Datetime')),
-                y=alt.Y('value:Q', scale=alt.Scale(nice=True)),
-                color='Measurement:N'
-            ).interactive()
-
-            # Update annotations to move with the data
-            annotation_layer = (
-                alt.Chart(annotations_data_tail)
-                .mark_text(size=25, text="⬇️", dx=0, dy=0, align="center")
-                .encode(x=alt.X("datetime:T", axis=None), y=alt.Y("y:Q"), tooltip=["value"])
-            )
-            # Show chart
-            combined_chart_gsr = gsr_chart + annotation_layer
-
-            # Build the GSR_raw line chart
-            gsr_raw_chart = alt.Chart(st.session_state.line_chart_data).transform_fold(
-                ["gsr_raw"],
-                as_=['Measurement', 'value']
-            ).mark_line().encode(
-                x=alt.X('datetime:T', axis=alt.Axis(title='datetime')),
-                y=alt.Y('value:Q', scale=alt.Scale(nice=True)),
-                color='Measurement:N'
-            ).interactive()
-
-            # Build the PPG line chart
-            ppg_chart = alt.Chart(st.session_state.line_chart_data).transform_fold(
-                ["ppg_raw"],
-                as_=['Measurement', 'value']
-            ).mark_line().encode(
-                x='datetime:T',
-                y=alt.Y('value:Q', scale=alt.Scale(nice=True)),
-                color='Measurement:N'
-            ).interactive()
-
-            with placeholder.container():
-                st.altair_chart(combined_chart_gsr, theme=None, use_container_width=True)
-                # st.altair_chart(ppg_chart, theme=None, use_container_width=True)
-                # st.altair_chart(gsr_raw_chart, theme=None, use_container_width=True)
-                time.sleep(1)
-
-            if stop_button:
-                st.session_state.device.stop_streaming()
-                st.session_state.device = None
-                st.toast('Shimmer disconnected', icon="🔌")
-                st.rerun()
+        with st.expander("Debug"):
+            debug_placeholder = st.empty()
+
+        render = get_render_scheduler().join()
+        try:
+            # Continuous data generation loop
+            while True:
+                live_data = st.session_state.device.get_live_data()
+
+                # Only redraw when a new sample or annotation came in
+                version = (live_data['datetime'].iloc[-1] if len(live_data) else None,
+                           len(st.session_state.annotations_df))
+                if render.changed(version):
+                    with render.frame():
+                        # Append livestreamed values to DataFrame
+                        st.session_state.line_chart_data = pd.concat(
+                            [st.session_state.line_chart_data, live_data]).drop_duplicates().reset_index(drop=True)
+
+                        # Keep only the last 40 datapoints, to create scrolling window effect
+                        st.session_state.line_chart_data = st.session_state.line_chart_data.tail(40)
+
+                        # Ensure annotations are in sync with the live data
+                        annotations_data_tail = st.session_state.annotations_df[
+                            st.session_state.annotations_df['datetime'] >=
+                            st.session_state.line_chart_data['datetime'].min()]
+
+                        with placeholder.container():
+                            for name in visible_charts:
+                                spec = live_chart_spec(name)
+                                spec['datasets'] = {'live': st.session_state.line_chart_data[['datetime', 'gsr',
+                                                                                              'gsr_raw', 'ppg_raw']],
+                                                    'annotations': annotations_data_tail}
+                                st.vega_lite_chart(spec, theme=None, use_container_width=True)
+
+                    stats = render.stats()
+                    debug_placeholder.caption(
+                        f"CPU {stats['cpu']:.0%} of a core, {stats['frame_cost'] * 1000:.1f} ms per frame, "
+                        f"a frame every {stats['interval']:.2f}s for {stats['tabs']} tabs, "
+                        f"{stats['frames']} frames drawn and {stats['skipped']} skipped without new data")
+
+                if stop_button:
+                    stop_stream()
+                    st.rerun()
+
+                render.wait()
+        finally:
+            render.close()
 
 with tab2:
     st.toast('Database connecting', icon="🔌")
 
     # Fetch data
-    # sensor_data = fetch_sensor_data(conn)
-    # sensor_data = fetch_recent_sensor_data(conn)
-    measurement_data = fetch_measurement_data(conn)
-    shimmer_data = fetch_shimmer_data(conn)
+    # sensor_data = storage.fetch_all_samples()
+    measurement_data = storage.fetch_measurements()
+    shimmer_data = storage.fetch_shimmers()
 
     # Create box with filter
     with st.expander("Filter"):
@@ -388,13 +323,13 @@ with tab2:
         # with col2:
         #     end_date = st.date_input("End date", sensor_data['datetime'].max().date())
         with col1:
-            games = fetch_training_types(conn)
+            games = storage.fetch_training_types()
             sel_game_hist = st.selectbox('Games', options=games, index=None, key='hist_game')
         with col2:
             sel_player_hist = st.selectbox('Player', options=list(player_dict.keys()), index=None, key='hist_player')
         with col3:
             # Create a dropdown for selecting a measurement session
-            measurement_ranges = fetch_measurement_ranges(conn)
+            measurement_ranges = storage.fetch_measurement_ranges()
             measurement_ranges['start_time_str'] = measurement_ranges['start_time'].dt.strftime('%Y-%m-%d %H:%M:%S')
 
             # Default index for usable datastream
@@ -421,21 +356,47 @@ with tab2:
     #     (sensor_data['datetime'] <= selected_range['end_time'])
     #     ]
 
-    rate = 100
-    filtered_data = fetch_filtered_sensor_data(conn, selected_range['start_time'], selected_range['end_time'],
-                                               selected_range['shimmer_id'])
+    filtered_data = fetch_session_data(storage, selected_range)
+
+    if len(filtered_data) < 2:
+        st.error("No sensor data recorded for this measurement session.")
+        st.stop()
 
     filtered_data['gsr'] = filtered_data['gsr_raw'].apply(shimmer.convert_ADC_to_GSR)
 
-    # calculate the peaks from raw ppg
-    peaks, info = nk.ppg_peaks(filtered_data['ppg_raw'], sampling_rate=rate)
-    # Check if `peaks` is empty
-    if len(peaks) == 0:
-        st.error("No peaks detected in the data. Please check the input data or adjust the peak detection parameters.")
+    # Use the rate the device actually sampled at, estimated once and stored with the session
+    rate = selected_range['sample_rate']
+    if pd.isna(rate):
+        rate = estimate_sampling_rate(filtered_data['data_timestamp'])
+        if rate is None:
+            st.error("Can't determine the sampling rate of this session, its device timestamps never change.")
+            st.stop()
+        storage.set_session_sample_rate(selected_range['session_id'], rate)
+
+    # HRV needs evenly spaced samples, host arrival times aren't. A grid point is bad when a bad sample is next to it
+    quality = filtered_data['quality'].astype(int)
+    filtered_data['gsr_bad'] = ((quality & GSR_BAD) != 0).astype(float)
+    filtered_data['ppg_bad'] = ((quality & PPG_BAD) != 0).astype(float)
+    filtered_data = resample_uniform(filtered_data, rate, columns=('gsr', 'ppg_raw', 'gsr_bad', 'ppg_bad'))
+    gsr_good = filtered_data['gsr_bad'] == 0
+    ppg_good = filtered_data['ppg_bad'] == 0
+
+    # Leave the saturated and flat GSR segments out of the GSR line
+    filtered_data.loc[~gsr_good, 'gsr'] = np.nan
+
+    # calculate the intervals between the peaks of raw ppg, within the segments without PPG saturation, flat lines
+    # or motion
+    intervals = ppg_intervals(filtered_data['ppg_raw'], ppg_good, rate)
+    # Check if there are any intervals
+    if intervals is None or len(intervals['RRI']) == 0:
+        st.error("No peaks detected in the good parts of the data. Please check the sensor placement or adjust the "
+                 "peak detection parameters.")
     else:
+        if not ppg_good.all():
+            st.caption(f"{(~ppg_good).mean():.0%} of this session was left out of the HRV because of poor PPG quality")
         try:
             # Proceed with HRV calculations as before
-            hrv_time = nk.hrv_time(peaks, sampling_rate=rate, show=True)
+            hrv_time = nk.hrv_time(intervals, sampling_rate=rate, show=True)
 
             # Calculate the heart rate
             rr_intervals_s = np.array(hrv_time['HRV_MeanNN']) / 1000.0
@@ -477,7 +438,7 @@ with tab2:
         title='GSR (galvanic skin response)'
     )
 
-    # ping_events = fetch_ping_events(conn, selected_range['shimmer_id'], selected_range['start_time'], selected_range['end_time'])
+    # ping_events = storage.fetch_ping_events(selected_range['session_id'])
     #
     # if not 1 or ping_events.empty:
     #     for index, row in ping_events.iterrows():
@@ -0,0 +1,49 @@
+USE [PSV]
+GO
+/****** Time-range query benchmark ******/
+-- Run once before and once after applying queries/migrations and compare the
+-- logical reads from STATISTICS IO, the elapsed time from STATISTICS TIME and
+-- the operators in the actual execution plan (include it with Ctrl+M in SSMS).
+-- Before migration 001 the sensor_data query shows a clustered index scan over
+-- the datetime range for every shimmer, after it a clustered index seek on one
+-- shimmer. The session queries need migration 005: a session's samples and
+-- pings are a seek on IX_sensor_data_session_datetime and IX_measurement_session
+-- instead of pairing start and stop events over all measurements.
+DECLARE @shimmer_id int = 3;
+DECLARE @start_time datetime = '2024-07-11 14:51:19';
+
+SET STATISTICS IO ON;
+SET STATISTICS TIME ON;
+
+-- RecentSensorCache.refresh
+SELECT * FROM dbo.sensor_data
+WHERE shimmer_id = @shimmer_id AND datetime > DATEADD(day, -7, GETDATE())
+ORDER BY datetime;
+
+-- fetch_measurement_ranges
+SELECT id AS session_id, player_id, shimmer_id, start_time, end_time, game, sample_rate
+FROM dbo.session
+WHERE end_time IS NOT NULL
+ORDER BY start_time DESC;
+
+DECLARE @session_id int = (SELECT TOP 1 id FROM dbo.session
+                           WHERE shimmer_id = @shimmer_id AND start_time >= @start_time
+                           ORDER BY start_time);
+
+-- fetch_session_samples
+SELECT * FROM dbo.sensor_data
+WHERE session_id = @session_id
+ORDER BY datetime;
+
+-- fetch_ping_events
+SELECT datetime, note FROM dbo.measurement
+WHERE session_id = @session_id AND event = 'ping'
+ORDER BY datetime;
+
+-- fetch_training_types
+SELECT DISTINCT game AS training_type
+FROM dbo.session;
+
+SET STATISTICS IO OFF;
+SET STATISTICS TIME OFF;
+GO
@@ -0,0 +1,29 @@
+USE [PSV]
+GO
+/****** Migration 001: order sensor_data by (shimmer_id, datetime) ******/
+-- Every read of sensor_data filters on one shimmer and a datetime range
+-- (fetch_filtered_sensor_data, the recent data cache). With the clustered key
+-- on (datetime, shimmer_id) those reads scan the whole range for all shimmers,
+-- with (shimmer_id, datetime) they become a single range seek.
+-- datetime also becomes datetime2(6): datetime rounds to 1/300 s, so samples
+-- timestamped from the device ticks collide in the key from about 150 Hz on.
+BEGIN TRANSACTION
+GO
+ALTER TABLE [dbo].[sensor_data] DROP CONSTRAINT [PK_sensor_data]
+GO
+ALTER TABLE [dbo].[sensor_data] ALTER COLUMN [datetime] [datetime2](6) NOT NULL
+GO
+ALTER TABLE [dbo].[sensor_data] ADD CONSTRAINT [PK_sensor_data] PRIMARY KEY CLUSTERED
+(
+	[shimmer_id] ASC,
+	[datetime] ASC
+)WITH (PAD_INDEX = OFF, STATISTICS_NORECOMPUTE = OFF, IGNORE_DUP_KEY = OFF, ALLOW_ROW_LOCKS = ON, ALLOW_PAGE_LOCKS = ON, OPTIMIZE_FOR_SEQUENTIAL_KEY = ON, DATA_COMPRESSION = PAGE) ON [PRIMARY]
+GO
+-- Keeps the stream grouping queries (ORDER BY datetime over all shimmers) from sorting
+CREATE NONCLUSTERED INDEX [IX_sensor_data_datetime] ON [dbo].[sensor_data]
+(
+	[datetime] ASC
+)WITH (DATA_COMPRESSION = PAGE) ON [PRIMARY]
+GO
+COMMIT TRANSACTION
+GO
@@ -0,0 +1,28 @@
+USE [PSV]
+GO
+/****** Migration 002: measurement column types and event lookup index ******/
+-- event was nchar(10), which pads every value and truncates anything longer
+-- than 'start_game'. note was ntext, which can't be used in DISTINCT
+-- (fetch_training_types) or in an index.
+BEGIN TRANSACTION
+GO
+ALTER TABLE [dbo].[measurement] ALTER COLUMN [event] [varchar](20) NOT NULL
+GO
+ALTER TABLE [dbo].[measurement] ALTER COLUMN [note] [nvarchar](max) NULL
+GO
+-- Trim the padding left behind by the nchar column
+UPDATE [dbo].[measurement] SET [event] = RTRIM([event])
+GO
+-- Covers the "most recent start_game" lookup in stop_streaming, fetch_ping_events
+-- and fetch_measurement_ranges without touching the clustered index
+CREATE NONCLUSTERED INDEX [IX_measurement_shimmer_event_datetime] ON [dbo].[measurement]
+(
+	[shimmer_id] ASC,
+	[event] ASC,
+	[datetime] ASC
+)
+INCLUDE ([player_id], [note])
+WITH (DATA_COMPRESSION = PAGE) ON [PRIMARY]
+GO
+COMMIT TRANSACTION
+GO
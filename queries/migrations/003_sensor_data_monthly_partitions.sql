@@ -0,0 +1,58 @@
+USE [PSV]
+GO
+/****** Migration 003 (optional): partition sensor_data by month ******/
+-- Only worth running once sensor_data holds several months of data. Lets old
+-- months be switched out or compressed separately and lets range queries skip
+-- whole partitions.
+-- One boundary per month from the oldest sample until a year from now. Add the
+-- next month before that runs out:
+--   ALTER PARTITION SCHEME [PS_sensor_data_month] NEXT USED [PRIMARY]
+--   ALTER PARTITION FUNCTION [PF_sensor_data_month]() SPLIT RANGE ('<first day of the month>')
+DECLARE @month date = (SELECT DATEFROMPARTS(YEAR(d), MONTH(d), 1)
+                       FROM (SELECT COALESCE(MIN([datetime]), GETDATE()) AS d FROM [dbo].[sensor_data]) oldest)
+DECLARE @last date = DATEADD(MONTH, 12, GETDATE())
+DECLARE @boundaries nvarchar(max) = ''
+WHILE @month <= @last
+BEGIN
+	SET @boundaries += CASE WHEN @boundaries = '' THEN '' ELSE ', ' END
+		+ '''' + CONVERT(char(10), @month, 23) + ''''
+	SET @month = DATEADD(MONTH, 1, @month)
+END
+EXEC ('CREATE PARTITION FUNCTION [PF_sensor_data_month] ([datetime2](6)) AS RANGE RIGHT FOR VALUES ('
+	+ @boundaries + ')')
+GO
+CREATE PARTITION SCHEME [PS_sensor_data_month]
+AS PARTITION [PF_sensor_data_month] ALL TO ([PRIMARY])
+GO
+BEGIN TRANSACTION
+GO
+DROP INDEX [IX_sensor_data_datetime] ON [dbo].[sensor_data]
+GO
+-- Created by migration 005 when that ran first. Every index has to be on the
+-- partition scheme, otherwise months can't be switched out.
+DROP INDEX IF EXISTS [IX_sensor_data_session_datetime] ON [dbo].[sensor_data]
+GO
+ALTER TABLE [dbo].[sensor_data] DROP CONSTRAINT [PK_sensor_data]
+GO
+ALTER TABLE [dbo].[sensor_data] ADD CONSTRAINT [PK_sensor_data] PRIMARY KEY CLUSTERED
+(
+	[shimmer_id] ASC,
+	[datetime] ASC
+)WITH (OPTIMIZE_FOR_SEQUENTIAL_KEY = ON, DATA_COMPRESSION = PAGE) ON [PS_sensor_data_month]([datetime])
+GO
+CREATE NONCLUSTERED INDEX [IX_sensor_data_datetime] ON [dbo].[sensor_data]
+(
+	[datetime] ASC
+)WITH (DATA_COMPRESSION = PAGE) ON [PS_sensor_data_month]([datetime])
+GO
+IF COL_LENGTH('dbo.sensor_data', 'session_id') IS NOT NULL
+	EXEC ('CREATE NONCLUSTERED INDEX [IX_sensor_data_session_datetime] ON [dbo].[sensor_data]
+	(
+		[session_id] ASC,
+		[datetime] ASC
+	)
+	INCLUDE ([data_timestamp], [gsr_raw], [ppg_raw], [quality])
+	WITH (DATA_COMPRESSION = PAGE) ON [PS_sensor_data_month]([datetime])')
+GO
+COMMIT TRANSACTION
+GO
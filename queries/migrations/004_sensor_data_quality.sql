@@ -0,0 +1,9 @@
+USE [PSV]
+GO
+/****** Migration 004: quality mask per sample ******/
+-- Bit mask written by QualityScorer on the acquisition path: 1 GSR saturated,
+-- 2 GSR flat line, 4 PPG saturated, 8 PPG flat line, 16 PPG motion. 0 is a good
+-- sample, which is what older data gets.
+ALTER TABLE [dbo].[sensor_data] ADD [quality] [tinyint] NOT NULL
+	CONSTRAINT [DF_sensor_data_quality] DEFAULT (0)
+GO
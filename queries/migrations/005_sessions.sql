@@ -0,0 +1,88 @@
+USE [PSV]
+GO
+/****** Migration 005: sessions ******/
+-- A session row is created together with its start_game event and closed together
+-- with its stop_game event, and events and samples carry its id. Looking up a
+-- session's data becomes a key lookup instead of pairing start and stop events.
+-- sample_rate is filled in the first time a session is analysed, so the rate
+-- estimated from the device ticks isn't computed again.
+BEGIN TRANSACTION
+GO
+CREATE TABLE [dbo].[session](
+	[id] [int] IDENTITY(1,1) NOT NULL,
+	[player_id] [int] NOT NULL,
+	[shimmer_id] [int] NOT NULL,
+	[game] [nvarchar](100) NULL,
+	[start_time] [datetime] NOT NULL,
+	[end_time] [datetime] NULL,
+	[sample_rate] [float] NULL,
+ CONSTRAINT [PK_session] PRIMARY KEY CLUSTERED ([id] ASC),
+ CONSTRAINT [FK_session_player] FOREIGN KEY ([player_id]) REFERENCES [dbo].[player] ([id]),
+ CONSTRAINT [FK_session_shimmer] FOREIGN KEY ([shimmer_id]) REFERENCES [dbo].[shimmer] ([id])
+) ON [PRIMARY]
+GO
+-- merge_session matches sessions pushed from local databases on these
+CREATE UNIQUE NONCLUSTERED INDEX [UX_session_shimmer_start_time] ON [dbo].[session]
+(
+	[shimmer_id] ASC,
+	[start_time] ASC
+)
+GO
+ALTER TABLE [dbo].[measurement] ADD [session_id] [int] NULL
+	CONSTRAINT [FK_measurement_session] FOREIGN KEY REFERENCES [dbo].[session] ([id])
+GO
+ALTER TABLE [dbo].[sensor_data] ADD [session_id] [int] NULL
+	CONSTRAINT [FK_sensor_data_session] FOREIGN KEY REFERENCES [dbo].[session] ([id])
+GO
+-- Every start_game becomes a session, ended by the first stop_game of the same
+-- shimmer before its next start_game. Sessions without a stop stay open.
+INSERT INTO [dbo].[session] ([player_id], [shimmer_id], [game], [start_time], [end_time])
+SELECT sg.[player_id], sg.[shimmer_id], LEFT(sg.[note], 100), sg.[datetime], stop.[datetime]
+FROM [dbo].[measurement] sg
+OUTER APPLY (
+	SELECT MIN(m.[datetime]) AS [next_start]
+	FROM [dbo].[measurement] m
+	WHERE m.[shimmer_id] = sg.[shimmer_id] AND m.[event] = 'start_game' AND m.[datetime] > sg.[datetime]
+) nxt
+OUTER APPLY (
+	SELECT MIN(m.[datetime]) AS [datetime]
+	FROM [dbo].[measurement] m
+	WHERE m.[shimmer_id] = sg.[shimmer_id] AND m.[event] = 'stop_game' AND m.[datetime] > sg.[datetime]
+		AND (nxt.[next_start] IS NULL OR m.[datetime] <= nxt.[next_start])
+) stop
+WHERE sg.[event] = 'start_game' AND sg.[shimmer_id] IS NOT NULL
+GO
+UPDATE m SET [session_id] = s.[id]
+FROM [dbo].[measurement] m
+INNER JOIN [dbo].[session] s ON s.[shimmer_id] = m.[shimmer_id] AND m.[datetime] >= s.[start_time]
+	AND m.[datetime] <= COALESCE(s.[end_time], s.[start_time])
+GO
+UPDATE d SET [session_id] = s.[id]
+FROM [dbo].[sensor_data] d
+INNER JOIN [dbo].[session] s ON s.[shimmer_id] = d.[shimmer_id] AND d.[datetime] >= s.[start_time]
+	AND d.[datetime] <= s.[end_time]
+GO
+-- fetch_session_samples reads a whole session through this index. When 003 was
+-- applied it goes on the same partition scheme, so months can still be switched
+-- out. When 003 runs later, it moves the index itself.
+DECLARE @index nvarchar(max) = N'CREATE NONCLUSTERED INDEX [IX_sensor_data_session_datetime] ON [dbo].[sensor_data]
+(
+	[session_id] ASC,
+	[datetime] ASC
+)
+INCLUDE ([data_timestamp], [gsr_raw], [ppg_raw], [quality])
+WITH (DATA_COMPRESSION = PAGE) ON '
+IF EXISTS (SELECT 1 FROM sys.partition_schemes WHERE [name] = 'PS_sensor_data_month')
+	EXEC (@index + N'[PS_sensor_data_month]([datetime])')
+ELSE
+	EXEC (@index + N'[PRIMARY]')
+GO
+CREATE NONCLUSTERED INDEX [IX_measurement_session] ON [dbo].[measurement]
+(
+	[session_id] ASC,
+	[event] ASC
+)
+INCLUDE ([datetime], [note])
+GO
+COMMIT TRANSACTION
+GO
@@ -0,0 +1,98 @@
+import threading
+import time
+from contextlib import contextmanager
+
+
+class RenderScheduler:
+    """
+    Paces the live charts of all dashboard tabs in this process.
+
+    The interval between frames grows with the number of tabs following a stream, and again when the process
+    spends more than target_cpu of a core, measured with time.process_time() over the last few seconds. Tabs only
+    redraw when their data or annotations changed, so an idle stream costs next to nothing.
+    """
+
+    def __init__(self, min_interval: float = 1.0, max_interval: float = 5.0, target_cpu: float = 0.5,
+                 load_window: float = 2.0):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.target_cpu = target_cpu
+        self.load_window = load_window
+
+        self.lock = threading.Lock()
+        self.clients = 0
+        self.cpu = 0.0  # fraction of one core used by the whole process
+        self.last_wall = time.monotonic()
+        self.last_cpu = time.process_time()
+
+    def join(self):
+        with self.lock:
+            self.clients += 1
+        return RenderClient(self)
+
+    def leave(self):
+        with self.lock:
+            self.clients = max(0, self.clients - 1)
+
+    def measure_load(self):
+        with self.lock:
+            wall, cpu = time.monotonic(), time.process_time()
+            if wall - self.last_wall >= self.load_window:
+                self.cpu = (cpu - self.last_cpu) / (wall - self.last_wall)
+                self.last_wall, self.last_cpu = wall, cpu
+            return self.cpu
+
+    def interval(self):
+        """Seconds between two frames of one tab."""
+        cpu = self.measure_load()
+        interval = self.min_interval * max(1, self.clients) * max(1.0, cpu / self.target_cpu)
+        return min(self.max_interval, interval)
+
+
+class RenderClient:
+    """One tab's view of the RenderScheduler, with its own frame statistics."""
+
+    def __init__(self, scheduler: RenderScheduler):
+        self.scheduler = scheduler
+        self.version = None
+        self.next_frame = time.monotonic()
+        self.frames = 0
+        self.skipped = 0
+        self.frame_cost = 0.0  # CPU seconds of the last frame, smoothed
+
+    def changed(self, version):
+        """Whether there's anything new to draw since the last frame, version being e.g. the newest datetime."""
+        if version == self.version:
+            self.skipped += 1
+            return False
+        self.version = version
+        return True
+
+    @contextmanager
+    def frame(self):
+        start = time.process_time()
+        try:
+            yield
+        finally:
+            cost = time.process_time() - start
+            self.frame_cost = cost if not self.frames else 0.8 * self.frame_cost + 0.2 * cost
+            self.frames += 1
+
+    def wait(self):
+        """Sleep until this tab's next frame is due."""
+        now = time.monotonic()
+        self.next_frame = max(now, self.next_frame + self.scheduler.interval())
+        time.sleep(self.next_frame - now)
+
+    def stats(self):
+        return {
+            'tabs': self.scheduler.clients,
+            'cpu': self.scheduler.cpu,
+            'interval': self.scheduler.interval(),
+            'frame_cost': self.frame_cost,
+            'frames': self.frames,
+            'skipped': self.skipped,
+        }
+
+    def close(self):
+        self.scheduler.leave()
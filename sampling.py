@@ -0,0 +1,63 @@
+import numpy as np
+import pandas as pd
+import neurokit2 as nk
+from clock import TICK_RATE, unwrap_ticks
+
+
+def estimate_sampling_rate(data_timestamp, tick_rate: float = TICK_RATE):
+    """
+    Sampling rate of a session from its device ticks, or None with too few samples.
+
+    The typical step between ticks is the sample period; the median ignores the gaps left by dropped packets.
+    The Shimmer derives its rate by dividing its clock, so the estimate is snapped to the nearest divider.
+    """
+    if len(data_timestamp) < 2:
+        return None
+    steps = np.diff(unwrap_ticks(data_timestamp))
+    steps = steps[steps > 0]
+    if len(steps) == 0:
+        return None
+    return tick_rate / max(1, round(float(np.median(steps))))
+
+
+def resample_uniform(data: pd.DataFrame, rate: float, columns=('gsr', 'ppg_raw'), tick_rate: float = TICK_RATE):
+    """
+    Linearly interpolate the given columns onto an evenly spaced grid at `rate`, using the device ticks as time.
+
+    The datetime column of the result starts at the first sample and steps exactly 1 / rate seconds.
+    """
+    seconds = (unwrap_ticks(data['data_timestamp']) - data['data_timestamp'].iloc[0]) / tick_rate
+    # np.interp needs increasing sample times, drop repeated ticks
+    increasing = np.diff(seconds, prepend=-np.inf) > 0
+    seconds = seconds[increasing]
+    grid = np.arange(0.0, seconds[-1], 1.0 / rate)
+
+    uniform = pd.DataFrame({'datetime': data['datetime'].iloc[0] + pd.to_timedelta(grid, unit='s')})
+    for column in columns:
+        uniform[column] = np.interp(grid, seconds, data[column].to_numpy(dtype=float)[increasing])
+    return uniform
+
+
+def good_segments(good, min_length: int):
+    """(start, stop) index pairs of the runs of good samples that are at least min_length long."""
+    edges = np.flatnonzero(np.diff(np.concatenate([[0], np.asarray(good, dtype=np.int8), [0]])))
+    return [(start, stop) for start, stop in zip(edges[::2], edges[1::2]) if stop - start >= min_length]
+
+
+def ppg_intervals(ppg, good, sampling_rate: float, min_seconds: float = 10.0):
+    """
+    RR intervals from the good segments of an evenly sampled PPG signal, in the dict format nk.hrv_time accepts.
+
+    Peaks are only detected within a segment, so no interval spans a bad stretch. RRI_Time keeps the real time of
+    every interval, which lets neurokit see the gaps between segments.
+    """
+    intervals, times = [], []
+    for start, stop in good_segments(good, int(min_seconds * sampling_rate)):
+        peaks, info = nk.ppg_peaks(np.asarray(ppg[start:stop]), sampling_rate=sampling_rate)
+        peak_times = (start + info['PPG_Peaks']) / sampling_rate
+        intervals.append(np.diff(peak_times) * 1000)
+        times.append(peak_times[1:])
+
+    if not intervals:
+        return None
+    return {'RRI': np.concatenate(intervals), 'RRI_Time': np.concatenate(times)}
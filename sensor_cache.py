@@ -0,0 +1,62 @@
+import threading
+from datetime import datetime, timedelta
+import pandas as pd
+import shimmer
+
+SENSOR_COLUMNS = ['datetime', 'shimmer_id', 'data_timestamp', 'gsr_raw', 'ppg_raw', 'quality', 'session_id', 'gsr']
+
+
+class RecentSensorCache:
+    """
+    Local copy of the most recent sensor_data per shimmer.
+
+    Every refresh only asks the database for rows newer than the last datetime seen for that shimmer
+    (the watermark), so the transfer is proportional to the new data instead of the size of the window.
+    """
+
+    def __init__(self, window: timedelta = timedelta(days=7)):
+        self.window = window
+        self.data = {}  # shimmer_id -> DataFrame with SENSOR_COLUMNS
+        self.watermarks = {}  # shimmer_id -> last datetime seen
+        self.lock = threading.Lock()
+
+    def refresh(self, storage, shimmer_ids=None):
+        """Fetch the new rows of the given shimmers, or of all shimmers when None."""
+        window_start = datetime.now() - self.window
+
+        with self.lock:
+            if shimmer_ids is None:
+                shimmer_ids = storage.fetch_shimmers()['id'].tolist()
+
+            for shimmer_id in map(int, shimmer_ids):
+                # Shimmers we haven't seen yet start at the beginning of the window
+                watermark = max(self.watermarks.get(shimmer_id, window_start), window_start)
+                new_rows = storage.fetch_samples_since(shimmer_id, watermark)
+
+                if not new_rows.empty:
+                    new_rows['gsr'] = new_rows['gsr_raw'].apply(shimmer.convert_ADC_to_GSR)
+                    self.watermarks[shimmer_id] = new_rows['datetime'].max()
+                    if shimmer_id in self.data:
+                        new_rows = pd.concat([self.data[shimmer_id], new_rows], ignore_index=True)
+                    self.data[shimmer_id] = new_rows
+
+            self.evict(window_start)
+
+    def evict(self, window_start):
+        # Drop everything that has scrolled out of the window
+        for shimmer_id, data in list(self.data.items()):
+            data = data[data['datetime'] >= window_start]
+            if data.empty:
+                del self.data[shimmer_id]
+            else:
+                self.data[shimmer_id] = data.reset_index(drop=True)
+
+    def get(self, shimmer_id=None):
+        with self.lock:
+            if shimmer_id is not None:
+                data = self.data.get(int(shimmer_id))
+                return data.copy() if data is not None else pd.DataFrame(columns=SENSOR_COLUMNS)
+
+            if not self.data:
+                return pd.DataFrame(columns=SENSOR_COLUMNS)
+            return pd.concat(list(self.data.values()), ignore_index=True).sort_values('datetime', ignore_index=True)
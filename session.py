@@ -0,0 +1,63 @@
+import threading
+from datetime import datetime
+from storage import Storage
+
+# Lifecycle of a session, it can only move forward
+CREATED, RUNNING, STOPPED = 'created', 'running', 'stopped'
+
+
+class Session:
+    """
+    One game of one player on one shimmer.
+
+    start() creates the session row and its start_game event in a single transaction, which allocates the id the
+    samples are tagged with. Pings are queued and written in batches by flush_events(), and stop() writes whatever
+    is still queued together with the stop_game event and the end time, so a session is never left half closed.
+    """
+
+    def __init__(self, storage: Storage, player_id, shimmer_id, game):
+        self.storage = storage
+        self.player_id = int(player_id)
+        self.shimmer_id = int(shimmer_id)
+        self.game = game
+
+        self.id = None
+        self.state = CREATED
+        self.start_time = self.end_time = None
+        self.pending = []  # (player_id, shimmer_id, event, note, datetime) waiting to be written
+        self.lock = threading.Lock()
+
+    def start(self, when=None):
+        with self.lock:
+            if self.state != CREATED:
+                raise RuntimeError(f"Can't start a session that is {self.state}")
+            self.start_time = when or datetime.now()
+            self.id = self.storage.start_session(self.player_id, self.shimmer_id, self.game, self.start_time)
+            self.state = RUNNING
+        return self
+
+    def add_event(self, event, note=None, when=None):
+        with self.lock:
+            if self.state != RUNNING:
+                raise RuntimeError(f"Can't add events to a session that is {self.state}")
+            self.pending.append((self.player_id, self.shimmer_id, event, note, when or datetime.now()))
+
+    def ping(self, note=None, when=None):
+        self.add_event('ping', note, when)
+
+    def flush_events(self):
+        with self.lock:
+            if self.state != RUNNING or not self.pending:
+                return
+            self.storage.add_session_events(self.id, self.pending)
+            self.pending = []
+
+    def stop(self, when=None):
+        with self.lock:
+            if self.state != RUNNING:
+                raise RuntimeError(f"Can't stop a session that is {self.state}")
+            self.end_time = when or datetime.now()
+            events = self.pending + [(self.player_id, self.shimmer_id, 'stop_game', self.game, self.end_time)]
+            self.storage.add_session_events(self.id, events, end_time=self.end_time)
+            self.pending = []
+            self.state = STOPPED
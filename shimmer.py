@@ -1,25 +1,28 @@
 import atexit
 import time
 import threading
-import pyodbc
+import numpy as np
 import pandas as pd
 import re
 from datetime import datetime
 from serial import Serial
 from pyshimmer import ShimmerBluetooth, DEFAULT_BAUDRATE, DataPacket, EChannelType
-import config
+from clock import ClockAligner
+from discovery import WarmDevice
+from session import Session
+from signal_quality import QualityScorer
+from storage import Storage, open_storage, open_store_and_forward
 
-
-def connect_db():
-    cnxn = pyodbc.connect(
-        driver="{ODBC Driver 17 for SQL Server}", server=config.server_host, database="PSV",
-        uid="team", pwd=config.password)
-    return cnxn
+# Number of packets that are timestamped and appended to live_data together
+FLUSH_SIZE = 32
+# Seconds between two writes of the uploaded samples and session events
+WRITE_INTERVAL = 0.5
 
 
 class ShimmerDevice:
 
-    def __init__(self, com_port, fake_fallback: bool = False, live_upload: bool = False):
+    def __init__(self, com_port, fake_fallback: bool = False, live_upload: bool = False, storage: Storage = None,
+                 live_window: int = None, warm: WarmDevice = None):
         # register exit methods
         atexit.register(self.safe_stop)
 
@@ -27,123 +30,215 @@ class ShimmerDevice:
                                                'datetime',
                                                'timestamp',
                                                'gsr_raw',
-                                               'ppg_raw'])
+                                               'ppg_raw',
+                                               'quality',
+                                               'session_id'])
         self.com_port = com_port
-        self.live_upload = live_upload
-
+        # Number of samples kept in live_data, everything when None
+        self.live_window = live_window
+        self.batch_callbacks = []
+        # Samples are tagged with the running session, in the acquisition daemon SessionControl starts and stops it
+        self.session = None
+        self.session_id = None
+
+        # Only close the storage on exit when we opened it ourselves
+        self.owns_storage = storage is None
         try:
-            self.serial = Serial(com_port, DEFAULT_BAUDRATE)
-            self.shim_dev = ShimmerBluetooth(self.serial)
+            self.storage = storage or open_storage()
         except Exception as e:
-            print(f"Failed to initialize Serial object with com_port: {com_port}. Error: {e}")
-            error_code = re.search(r'None, (\d+)\)', str(e))
-            if fake_fallback and error_code and error_code.group(1) == '121':
-                print("Falling back to FakeShimmerBluetooth")
-                self.shim_dev = FakeShimmerBluetooth()
-            else:
-                raise e
-
-        self.shim_dev.initialize()
+            print(f"Failed to connect to the database. Error: {e}")
+            print("Falling back to local storage with store-and-forward sync")
+            self.storage = open_store_and_forward()
+
+        # With store-and-forward, write in-progress sessions to the local database right away
+        self.live_upload = live_upload or getattr(self.storage, 'sync_agent', None) is not None
+
+        if warm is not None:
+            # Opened, initialized and registered by DeviceDiscovery with this same storage
+            self.serial, self.shim_dev = warm.serial, warm.shim_dev
+            self.batt, self.dev_name, self.sampling_rate = warm.battery, warm.name, warm.sampling_rate
+        else:
+            try:
+                self.serial = Serial(com_port, DEFAULT_BAUDRATE)
+                self.shim_dev = ShimmerBluetooth(self.serial)
+            except Exception as e:
+                print(f"Failed to initialize Serial object with com_port: {com_port}. Error: {e}")
+                error_code = re.search(r'None, (\d+)\)', str(e))
+                if fake_fallback and error_code and error_code.group(1) == '121':
+                    print("Falling back to FakeShimmerBluetooth")
+                    self.shim_dev = FakeShimmerBluetooth(self.storage)
+                else:
+                    raise e
+
+            self.shim_dev.initialize()
+
+            self.batt = self.shim_dev.get_battery_state(True)
+            self.dev_name = self.shim_dev.get_device_name()
+            self.sampling_rate = self.shim_dev.get_sampling_rate()
         self.init_time = datetime.now()
-
-        self.batt = self.shim_dev.get_battery_state(True)
-        self.dev_name = self.shim_dev.get_device_name()
-        print(f'My name is: {self.dev_name} and my battery is at {self.batt}%')
+        print(f'My name is: {self.dev_name} and my battery is at {self.batt}%, sampling at {self.sampling_rate} Hz')
+
+        # Raw packets waiting to be timestamped, filled by the pyshimmer reader thread
+        self.pending = []
+        self.pending_lock = threading.Lock()
+        self.last_arrival = None
+        self.flush_lock = threading.Lock()
+        # Batches waiting to be uploaded by the writer thread, which also writes the session's queued events, so the
+        # database never blocks or ends the reader thread
+        self.unsaved = []
+        self.unsaved_lock = threading.Lock()
+        self.writer = None
+        self.writer_stop = threading.Event()
+        self.clock = ClockAligner(self.sampling_rate)
+        self.quality = QualityScorer(self.sampling_rate)
 
         self.shim_dev.add_stream_callback(self.handler)
 
-        self.cnxn = connect_db()
-
-        with self.cnxn.cursor() as cursor:
-            cursor.execute("""MERGE INTO dbo.shimmer AS target
-        USING (SELECT ?, ?, ?) AS source (name, port, battery_perc)
-        ON (target.name = source.name)
-        WHEN MATCHED THEN
-            UPDATE SET target.port = source.port, target.battery_perc = source.battery_perc
-        WHEN NOT MATCHED THEN
-            INSERT (name, port, battery_perc)
-            VALUES (source.name, source.port, source.battery_perc)
-        OUTPUT INSERTED.id;
-                    """, (self.dev_name, self.com_port, self.batt))
-            self.id = cursor.fetchone()[0]
-
-        self.cnxn.commit()
+        self.id = warm.shimmer_id if warm is not None else \
+            self.storage.register_shimmer(self.dev_name, self.com_port, self.batt)
 
     def handler(self, pkt: DataPacket):
-        curtime = datetime.now()
-
-        timestamp = pkt[EChannelType.TIMESTAMP]
-        gsr_raw = pkt[EChannelType.GSR_RAW]
-        ppg_raw = pkt[EChannelType.INTERNAL_ADC_13]
-        # print(pkt.channels)
-        # print(f'Received new data point at {timestamp}: GSR {gsr_raw}, PPG {ppg_raw}')
-
-        # Ignore the first few seconds of data coming in as it's unreliable
-        if (curtime - self.init_time).total_seconds() < 4:
-            return
-
-        new_row = pd.DataFrame({'datetime': [curtime],
-                                'gsr': [convert_ADC_to_GSR(gsr_raw)],
-                                'timestamp': [timestamp],
-                                'gsr_raw': [gsr_raw],
-                                'ppg_raw': [ppg_raw]
-                                })
-        self.live_data = pd.concat([self.live_data, new_row], ignore_index=True)
-
-        if self.live_upload:
-            with self.cnxn.cursor() as cursor:
-                cursor.execute(
-                    """INSERT INTO sensor_data(shimmer_id, data_timestamp, gsr_raw, ppg_raw)
-                VALUES (?, ?, ?, ?)""",
-                    self.id, timestamp, gsr_raw, ppg_raw)
-                self.cnxn.commit()
+        with self.pending_lock:
+            self.pending.append((pkt[EChannelType.TIMESTAMP],
+                                 pkt[EChannelType.GSR_RAW],
+                                 pkt[EChannelType.INTERNAL_ADC_13]))
+            # Host time of the newest packet, the clock fit pairs it with that packet's ticks
+            self.last_arrival = time.time()
+            full = len(self.pending) >= FLUSH_SIZE
+
+        if full:
+            self.flush()
+
+    def flush(self):
+        """Timestamp the packets received since the last flush and append them to live_data in one go."""
+        # Runs on the reader thread and on the dashboard thread (get_live_data). The clock, the quality scorer and
+        # live_data keep state from batch to batch, so batches are processed one at a time and in order
+        with self.flush_lock:
+            with self.pending_lock:
+                batch, self.pending = self.pending, []
+                arrival = self.last_arrival
+            if not batch:
+                return
+
+            # Everything else follows from the device ticks
+            host_time = time.time()
+            host_now = datetime.now()
+            timestamp, gsr_raw, ppg_raw = np.array(batch, dtype=np.int64).T
+            seconds = self.clock.align(timestamp, arrival)
+
+            new_rows = pd.DataFrame({'datetime': pd.Timestamp(host_now) + pd.to_timedelta(seconds - host_time,
+                                                                                          unit='s'),
+                                     'gsr': [convert_ADC_to_GSR(value) for value in gsr_raw],
+                                     'timestamp': timestamp,
+                                     'gsr_raw': gsr_raw,
+                                     'ppg_raw': ppg_raw,
+                                     'quality': self.quality.score(gsr_raw, ppg_raw),
+                                     'session_id': self.session_id
+                                     })
+
+            # Ignore the first few seconds of data coming in as it's unreliable
+            new_rows = new_rows[new_rows['datetime'] >= self.init_time + pd.Timedelta(seconds=4)]
+            if new_rows.empty:
+                return
+
+            self.live_data = pd.concat([self.live_data, new_rows], ignore_index=True)
+            if self.live_window is not None:
+                self.live_data = self.live_data.tail(self.live_window)
+
+            if self.live_upload:
+                with self.unsaved_lock:
+                    self.unsaved.append(new_rows)
+            for callback in self.batch_callbacks:
+                callback(new_rows)
+
+    def write_loop(self):
+        while not self.writer_stop.wait(WRITE_INTERVAL):
+            self.write()
+
+    def write(self):
+        """
+        Upload the batches flushed since the last write and the session's queued events. When that fails they are
+        tried again next time.
+        """
+        with self.unsaved_lock:
+            batches, self.unsaved = self.unsaved, []
+        if batches:
+            try:
+                self.storage.insert_samples(self.id, pd.concat(batches, ignore_index=True))
+            except Exception as e:
+                print(f"Failed to upload {sum(len(batch) for batch in batches)} samples, retrying. Error: {e}")
+                with self.unsaved_lock:
+                    self.unsaved = batches + self.unsaved
+
+        session = self.session
+        if session:
+            try:
+                # The events stay queued on the session when this fails
+                session.flush_events()
+            except Exception as e:
+                print(f"Failed to write the events of session {session.id}, retrying. Error: {e}")
+
+    def add_batch_callback(self, callback):
+        """Call callback with every newly timestamped batch of samples, from the thread that flushed it."""
+        self.batch_callbacks.append(callback)
 
     def get_live_data(self):
+        self.flush()
         return self.live_data
 
+    def start_session(self, player_id, game):
+        self.session = Session(self.storage, player_id, self.id, game).start()
+        self.session_id = self.session.id
+        return self.session
+
+    def stop_session(self, when=None):
+        session, self.session, self.session_id = self.session, None, None
+        if session:
+            session.stop(when)
+
     def start_streaming(self):
+        self.clock.reset()
+        if self.writer is None:
+            self.writer_stop.clear()
+            self.writer = threading.Thread(target=self.write_loop, name=f"Writer-{self.com_port}", daemon=True)
+            self.writer.start()
         self.shim_dev.start_streaming()
 
     def stop_streaming(self, stop_event: bool = True, upload_data: bool = True):
         self.shim_dev.stop_streaming()
+        self.flush()
+        if self.writer is not None:
+            self.writer_stop.set()
+            self.writer.join()
+            self.writer = None
+            # Last attempt for whatever is left
+            self.write()
+            if self.unsaved:
+                print(f"Lost {sum(len(batch) for batch in self.unsaved)} samples that couldn't be uploaded")
+                self.unsaved = []
+        if self.clock.dropped:
+            print(f'{self.dev_name} dropped {self.clock.dropped} packets in {len(self.clock.gaps)} gaps')
         if stop_event:
-            # Crate stop_game event based on the device's last start_game event
-            with self.cnxn.cursor() as cursor:
-                query = """
-                WITH RecentPlayerId AS (
-                    SELECT TOP 1 player_id, note
-                    FROM measurement
-                    WHERE shimmer_id = ? AND event = 'start_game'
-                    ORDER BY datetime DESC
-                )
-                INSERT INTO measurement (player_id, shimmer_id, event, note)
-                SELECT player_id, ?, 'stop_game', note
-                FROM RecentPlayerId
-                """
-                cursor.execute(query, (self.id, self.id))
-                self.cnxn.commit()
-
-        if upload_data:
-            for index, row in self.live_data.iterrows():
-                with self.cnxn.cursor() as cursor:
-                    cursor.execute(
-                        """INSERT INTO sensor_data(datetime, shimmer_id, data_timestamp, gsr_raw, ppg_raw)
-                        VALUES (?, ?, ?, ?, ?)""",
-                        row['datetime'], self.id, row['timestamp'], row['gsr_raw'], row['ppg_raw'])
-                    self.cnxn.commit()
-
-                # Clear the live_data DataFrame
-                self.live_data = pd.DataFrame(columns=['gsr', 'datetime', 'timestamp', 'gsr_raw', 'ppg_raw'])
-
-        self.live_data = pd.DataFrame(columns=['gsr', 'datetime', 'timestamp', 'gsr_raw', 'ppg_raw'])
+            self.stop_session()
+
+        # Hold the flush lock so a late packet can't add to live_data between the upload and the reset
+        with self.flush_lock:
+            # Already uploaded sample by sample when live_upload is on
+            if upload_data and not self.live_upload:
+                self.storage.insert_samples(self.id, self.live_data)
+
+            self.live_data = pd.DataFrame(columns=['gsr', 'datetime', 'timestamp', 'gsr_raw', 'ppg_raw', 'quality',
+                                                   'session_id'])
+        self.session = None
+        self.session_id = None
         self.shim_dev.shutdown()
         self.shim_dev._initialized = False
 
     def safe_stop(self):
         if self.shim_dev.initialized():
             self.stop_streaming()
-        if self.cnxn:
-            self.cnxn.close()
+        if self.owns_storage and self.storage.cnxn:
+            self.storage.close()
             print("Database connection closed.")
 
     def __del__(self):
@@ -175,39 +270,16 @@ def convert_ADC_to_GSR(gsr_raw_value):
 
 
 class FakeShimmerBluetooth:
-    def __init__(self):
+    def __init__(self, storage: Storage = None):
         self._initialized = False
         self.index = 0
         self.stop_thread = False
 
         self.live_data = pd.DataFrame(columns=['timestamp', 'gsr_raw', 'ppg_raw'])
 
-        # Establish a connection to the database
-        self.cnxn = connect_db()
-
-        # Fetch the data from the database
-        self.data = self.fetch_data()
-
-    def fetch_data(self):
-        with self.cnxn.cursor() as cursor:
-            cursor.execute("""
-                WITH StreamData AS (
-                    SELECT event,
-                           datetime
-                    FROM [PSV].[dbo].[measurement]
-                    WHERE shimmer_id = 3 AND event IN ('fake_start', 'fake_end')
-                )
-                SELECT *
-                FROM [PSV].[dbo].[sensor_data]
-                WHERE datetime BETWEEN (SELECT datetime FROM StreamData WHERE event = 'fake_start') 
-                                  AND (SELECT datetime FROM StreamData WHERE event = 'fake_end')
-            """)
-
-            # Fetch the results and convert them to a DataFrame
-            data = cursor.fetchall()
-            data = pd.DataFrame.from_records(data, columns=[column[0] for column in self.cursor.description])
-
-            return data
+        # Fetch the recorded stream from whichever storage backend is in use
+        self.storage = storage or open_storage()
+        self.data = self.storage.fetch_fake_stream()
 
     def initialize(self):
         self._initialized = True
@@ -218,6 +290,9 @@ class FakeShimmerBluetooth:
     def get_device_name(self):
         return "Fake Device"
 
+    def get_sampling_rate(self):
+        return 4.0
+
     def add_stream_callback(self, handler):
         pass
 
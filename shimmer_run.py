@@ -1,12 +1,37 @@
+import sys
 import time
 
+from live_bus import LiveBus, SessionControl, bus_name
 from shimmer import ShimmerDevice
 
-# Demo of how to use shimmer.py to use the Shimmer for data collection
+# Acquisition daemon: owns the Shimmer on one COM port, uploads every sample and publishes it on a shared memory
+# LiveBus, so any number of dashboard processes can follow the stream without opening the port themselves.
+# Sessions are started by a dashboard but run here, see SessionControl.
+# Usage: python shimmer_run.py COM3 [seconds]
 if __name__ == '__main__':
-    device = ShimmerDevice('COM3')
+    com_port = sys.argv[1] if len(sys.argv) > 1 else 'COM3'
+    duration = float(sys.argv[2]) if len(sys.argv) > 2 else None
+
+    device = ShimmerDevice(com_port, live_upload=True, live_window=0)
+    # Fails when another daemon already owns this port
+    bus = LiveBus(bus_name(com_port), create=True, shimmer_id=device.id, sampling_rate=device.sampling_rate)
+    device.add_batch_callback(bus.publish)
+    control = SessionControl(device, bus).start()
     device.start_streaming()
-    time.sleep(10.0)
-    device.stop_streaming()
+    print(f'Publishing {device.dev_name} on {bus_name(com_port)}, press Ctrl+C to stop')
+
+    try:
+        start = time.time()
+        while duration is None or time.time() - start < duration:
+            # Stops the session of a dashboard that went away
+            control.check()
+            time.sleep(0.1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        control.close()
+        # Also stops a session that is still running
+        device.stop_streaming()
+        bus.close()
 
 exit(0)
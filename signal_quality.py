@@ -0,0 +1,101 @@
+import numpy as np
+
+# Bits of the quality mask, 0 means the sample is good. Each channel has its own bits, so an analysis of one
+# channel only skips what's wrong with that channel
+GSR_SATURATED = 1  # GSR clamped at the bottom of range 3 (electrode lift-off) or its ADC at the rail
+GSR_FLATLINE = 2  # GSR stuck at the same value, the sensor isn't reading anything
+PPG_SATURATED = 4  # PPG ADC at the rail
+PPG_FLATLINE = 8  # PPG stuck at the same value
+PPG_MOTION = 16  # PPG variance far above its usual level, the finger or wrist moved
+
+GSR_BAD = GSR_SATURATED | GSR_FLATLINE
+PPG_BAD = PPG_SATURATED | PPG_FLATLINE | PPG_MOTION
+
+ADC_MAX = 4095
+# convert_ADC_to_GSR clamps range 3 readings below this value
+GSR_RANGE_3_MIN = 683
+
+
+class QualityScorer:
+    """
+    Streaming quality mask for GSR and PPG samples, at a constant cost per sample.
+
+    The PPG variance is kept over a fixed window with running sums and compared to a slowly adapting baseline of
+    the variance during good signal. The baseline starts at the quietest of the first few windows without
+    saturation or flat lines, so motion at the start can't inflate it. Flat lines are detected with run lengths.
+    """
+
+    def __init__(self, sampling_rate: float, window_seconds: float = 2.0, ppg_flat_seconds: float = 0.5,
+                 gsr_flat_seconds: float = 5.0, motion_factor: float = 9.0, baseline_alpha: float = 0.001,
+                 seed_windows: int = 3):
+        self.window = max(2, int(sampling_rate * window_seconds))
+        # GSR moves slowly and can legitimately sit on one ADC value for a while, PPG can't
+        self.ppg_flat_length = max(2, int(sampling_rate * ppg_flat_seconds))
+        self.gsr_flat_length = max(2, int(sampling_rate * gsr_flat_seconds))
+        self.motion_factor = motion_factor
+        self.baseline_alpha = baseline_alpha
+        self.seed_windows = seed_windows
+
+        self.values = np.zeros(self.window)
+        self.index = 0
+        self.count = 0
+        self.sum = 0.0
+        self.sum_squares = 0.0
+        self.baseline = None
+        self.seed = []  # variances of clean windows until the baseline is known
+        self.clean_run = 0  # PPG samples in a row without saturation or flat lines
+
+        self.last_ppg = self.last_gsr = None
+        self.ppg_run = self.gsr_run = 0
+
+    def variance(self, value):
+        # Replace the oldest value in the window and update the running sums
+        oldest = self.values[self.index]
+        self.values[self.index] = value
+        self.index = (self.index + 1) % self.window
+        if self.count < self.window:
+            self.count += 1
+            oldest = 0.0
+        self.sum += value - oldest
+        self.sum_squares += value * value - oldest * oldest
+        mean = self.sum / self.count
+        return max(0.0, self.sum_squares / self.count - mean * mean)
+
+    def score_sample(self, gsr_raw, ppg_raw):
+        quality = 0
+
+        gsr_range = (gsr_raw >> 14) & 0x03
+        gsr_adc = gsr_raw & ADC_MAX
+        if (gsr_range == 3 and gsr_adc < GSR_RANGE_3_MIN) or gsr_adc in (0, ADC_MAX):
+            quality |= GSR_SATURATED
+        if ppg_raw <= 0 or ppg_raw >= ADC_MAX:
+            quality |= PPG_SATURATED
+
+        self.ppg_run = self.ppg_run + 1 if ppg_raw == self.last_ppg else 1
+        self.gsr_run = self.gsr_run + 1 if gsr_raw == self.last_gsr else 1
+        self.last_ppg, self.last_gsr = ppg_raw, gsr_raw
+        if self.gsr_run >= self.gsr_flat_length:
+            quality |= GSR_FLATLINE
+        if self.ppg_run >= self.ppg_flat_length:
+            quality |= PPG_FLATLINE
+
+        ppg_bad = quality & PPG_BAD
+        self.clean_run = 0 if ppg_bad else self.clean_run + 1
+        variance = self.variance(float(ppg_raw))
+        if self.baseline is None:
+            # One variance per whole window of clean signal
+            if self.clean_run >= self.window and self.clean_run % self.window == 0:
+                self.seed.append(variance)
+                if len(self.seed) == self.seed_windows:
+                    self.baseline = min(self.seed)
+        elif variance > self.motion_factor * self.baseline:
+            quality |= PPG_MOTION
+        elif not ppg_bad:
+            self.baseline += self.baseline_alpha * (variance - self.baseline)
+
+        return quality
+
+    def score(self, gsr_raw, ppg_raw) -> np.ndarray:
+        """Quality mask for one block of samples, the state carries over to the next block."""
+        return np.array([self.score_sample(int(gsr), int(ppg)) for gsr, ppg in zip(gsr_raw, ppg_raw)],
+                        dtype=np.uint8)
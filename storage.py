@@ -0,0 +1,551 @@
+import sqlite3
+from abc import ABC, abstractmethod
+import threading
+from datetime import datetime
+import numpy as np
+import pandas as pd
+import pyodbc
+import config
+
+
+def connect_db():
+    cnxn = pyodbc.connect(
+        driver="{ODBC Driver 17 for SQL Server}", server=config.server_host, database="PSV",
+        uid="team", pwd=config.password)
+    return cnxn
+
+
+def open_storage(backend=None):
+    """Open the storage backend chosen in config.py (storage_backend = "sqlserver", "sqlite" or "store_and_forward")."""
+    backend = backend or getattr(config, 'storage_backend', 'sqlserver')
+    if backend == 'sqlite':
+        return SqliteStorage(getattr(config, 'local_db_path', 'psv_local.db'))
+    if backend == 'sqlserver':
+        return SqlServerStorage()
+    if backend == 'store_and_forward':
+        return open_store_and_forward()
+    raise ValueError(f"Unknown storage backend: {backend}")
+
+
+def open_store_and_forward():
+    """Record into the local database and let a background SyncAgent push everything to SQL Server."""
+    # Imported here because sync.py needs the storage classes itself
+    from sync import SyncAgent
+
+    local = SqliteStorage(getattr(config, 'local_db_path', 'psv_local.db'))
+    local.sync_agent = SyncAgent(local)
+    local.sync_agent.start()
+    return local
+
+
+class Storage(ABC):
+    """
+    Persistence for players, devices, measurement events and sensor samples.
+
+    All queries that both SQL Server and SQLite understand live here, the subclasses only provide the
+    connection and the few statements where the dialects differ. Both drivers use ? placeholders.
+    """
+
+    def __init__(self, cnxn):
+        self.cnxn = cnxn
+        # The stream callback runs on the pyshimmer reader thread, so the connection is shared between threads
+        self.lock = threading.RLock()
+
+    def read(self, query, params=None, parse_dates=None):
+        with self.lock:
+            return pd.read_sql(query, self.cnxn, params=params, parse_dates=parse_dates)
+
+    def execute(self, query, params=()):
+        with self.lock:
+            cursor = self.cnxn.cursor()
+            try:
+                cursor.execute(query, params)
+                self.cnxn.commit()
+            finally:
+                cursor.close()
+
+    def executemany(self, query, rows):
+        if not rows:
+            return
+        with self.lock:
+            cursor = self.cnxn.cursor()
+            try:
+                cursor.executemany(query, rows)
+                self.cnxn.commit()
+            except Exception:
+                self.cnxn.rollback()
+                raise
+            finally:
+                cursor.close()
+
+    def close(self):
+        with self.lock:
+            if self.cnxn:
+                self.cnxn.close()
+                self.cnxn = None
+
+    # Devices and players
+
+    @abstractmethod
+    def register_shimmer(self, name, port, battery_perc):
+        """Insert or update a shimmer by its unique name and return its id."""
+
+    def fetch_players(self):
+        return self.read("SELECT * FROM player")
+
+    def fetch_shimmers(self):
+        return self.read("SELECT * FROM shimmer")
+
+    # Events
+
+    def fetch_measurements(self):
+        return self.read("SELECT * FROM measurement", parse_dates=['datetime'])
+
+    # Sessions
+
+    @abstractmethod
+    def insert_session(self, cursor, player_id, shimmer_id, game, start_time):
+        """Insert a session row with the given cursor and return its id."""
+
+    def start_session(self, player_id, shimmer_id, game, start_time):
+        """Create a session and its start_game event in one transaction, and return the session id."""
+        with self.lock:
+            cursor = self.cnxn.cursor()
+            try:
+                session_id = self.insert_session(cursor, int(player_id), int(shimmer_id), game, start_time)
+                cursor.execute("""
+                    INSERT INTO measurement (session_id, player_id, shimmer_id, event, note, datetime)
+                    VALUES (?, ?, ?, 'start_game', ?, ?)
+                    """, (session_id, int(player_id), int(shimmer_id), game, start_time))
+                self.cnxn.commit()
+            except Exception:
+                self.cnxn.rollback()
+                raise
+            finally:
+                cursor.close()
+        return session_id
+
+    def add_session_events(self, session_id, events, end_time=None):
+        """
+        Write a batch of (player_id, shimmer_id, event, note, datetime) events of a session in one transaction.
+        With end_time the session is closed in the same transaction.
+        """
+        with self.lock:
+            cursor = self.cnxn.cursor()
+            try:
+                if events:
+                    cursor.executemany("""
+                        INSERT INTO measurement (session_id, player_id, shimmer_id, event, note, datetime)
+                        VALUES (?, ?, ?, ?, ?, ?)
+                        """, [(int(session_id),) + tuple(event) for event in events])
+                if end_time is not None:
+                    cursor.execute("UPDATE session SET end_time = ? WHERE id = ?", (end_time, int(session_id)))
+                self.cnxn.commit()
+            except Exception:
+                self.cnxn.rollback()
+                raise
+            finally:
+                cursor.close()
+
+    def fetch_measurement_ranges(self):
+        """The finished sessions, newest first."""
+        return self.read("""
+            SELECT id AS session_id, player_id, shimmer_id, start_time, end_time, game, sample_rate
+            FROM session
+            WHERE end_time IS NOT NULL
+            ORDER BY start_time DESC
+            """, parse_dates=['start_time', 'end_time'])
+
+    def set_session_sample_rate(self, session_id, sample_rate):
+        """Remember the estimated sampling rate of a session."""
+        self.execute("UPDATE session SET sample_rate = ? WHERE id = ?", (float(sample_rate), int(session_id)))
+
+    def fetch_training_types(self):
+        games = self.read("""
+            WITH CTE AS (
+                SELECT game,
+                       -- Add a column for sorting purposes
+                       CASE WHEN game = 'None' THEN 1 ELSE 0 END AS SortOrder
+                FROM session
+            )
+            SELECT DISTINCT game AS training_type, SortOrder
+            FROM CTE
+            ORDER BY SortOrder, game
+            """)
+        return games['training_type'].tolist()
+
+    def fetch_ping_events(self, session_id):
+        return self.read("""
+            SELECT datetime, note FROM measurement
+            WHERE session_id = ? AND event = 'ping'
+            ORDER BY datetime
+            """, params=(int(session_id),), parse_dates=['datetime'])
+
+    # Samples
+
+    @staticmethod
+    def sample_rows(shimmer_id, samples: pd.DataFrame):
+        # Plain python types, neither driver knows what to do with numpy scalars
+        quality = samples['quality'].astype(np.int64).tolist() if 'quality' in samples else [0] * len(samples)
+        session_ids = [None if pd.isna(session_id) else int(session_id) for session_id in samples['session_id']] \
+            if 'session_id' in samples else [None] * len(samples)
+        return list(zip([int(shimmer_id)] * len(samples),
+                        pd.to_datetime(samples['datetime']).dt.to_pydatetime().tolist(),
+                        samples['timestamp'].astype(np.int64).tolist(),
+                        samples['gsr_raw'].astype(np.int64).tolist(),
+                        samples['ppg_raw'].astype(np.int64).tolist(),
+                        quality,
+                        session_ids))
+
+    def insert_samples(self, shimmer_id, samples: pd.DataFrame):
+        """
+        Bulk insert a DataFrame with datetime, timestamp, gsr_raw, ppg_raw and optionally quality and session_id
+        columns.
+        """
+        if samples.empty:
+            return
+        self.executemany("""
+            INSERT INTO sensor_data(shimmer_id, datetime, data_timestamp, gsr_raw, ppg_raw, quality, session_id)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            """, self.sample_rows(shimmer_id, samples))
+
+    def fetch_session_samples(self, session_id):
+        return self.read("""
+            SELECT * FROM sensor_data
+            WHERE session_id = ?
+            ORDER BY datetime
+            """, params=(int(session_id),), parse_dates=['datetime'])
+
+    def fetch_samples_since(self, shimmer_id, after):
+        return self.read("""
+            SELECT * FROM sensor_data
+            WHERE shimmer_id = ? AND datetime > ?
+            ORDER BY datetime
+            """, params=(int(shimmer_id), after), parse_dates=['datetime'])
+
+    def fetch_all_samples(self):
+        return self.read("SELECT * FROM sensor_data", parse_dates=['datetime'])
+
+    def fetch_fake_stream(self):
+        """Recorded stream replayed by FakeShimmerBluetooth, marked by the fake_start and fake_end events."""
+        return self.read("""
+            WITH StreamData AS (
+                SELECT event,
+                       datetime
+                FROM measurement
+                WHERE shimmer_id = 3 AND event IN ('fake_start', 'fake_end')
+            )
+            SELECT *
+            FROM sensor_data
+            WHERE datetime BETWEEN (SELECT datetime FROM StreamData WHERE event = 'fake_start')
+                              AND (SELECT datetime FROM StreamData WHERE event = 'fake_end')
+            ORDER BY datetime
+            """, parse_dates=['datetime'])
+
+
+class SqlServerStorage(Storage):
+    """The central PSV database on SQL Server."""
+
+    def __init__(self, cnxn=None):
+        super().__init__(cnxn or connect_db())
+
+    def executemany(self, query, rows):
+        if not rows:
+            return
+        with self.lock:
+            cursor = self.cnxn.cursor()
+            # Send the parameters as one array instead of a round trip per row
+            cursor.fast_executemany = True
+            try:
+                cursor.executemany(query, rows)
+                self.cnxn.commit()
+            except Exception:
+                self.cnxn.rollback()
+                raise
+            finally:
+                cursor.close()
+
+    def register_shimmer(self, name, port, battery_perc):
+        with self.lock:
+            with self.cnxn.cursor() as cursor:
+                cursor.execute("""MERGE INTO dbo.shimmer AS target
+                USING (SELECT ?, ?, ?) AS source (name, port, battery_perc)
+                ON (target.name = source.name)
+                WHEN MATCHED THEN
+                    UPDATE SET target.port = source.port, target.battery_perc = source.battery_perc
+                WHEN NOT MATCHED THEN
+                    INSERT (name, port, battery_perc)
+                    VALUES (source.name, source.port, source.battery_perc)
+                OUTPUT INSERTED.id;
+                """, (name, port, battery_perc))
+                shimmer_id = cursor.fetchone()[0]
+            self.cnxn.commit()
+        return shimmer_id
+
+    def insert_session(self, cursor, player_id, shimmer_id, game, start_time):
+        cursor.execute("""
+            INSERT INTO dbo.session (player_id, shimmer_id, game, start_time)
+            OUTPUT INSERTED.id
+            VALUES (?, ?, ?, ?)
+            """, (player_id, shimmer_id, game, start_time))
+        return cursor.fetchone()[0]
+
+    def merge_session(self, player_id, shimmer_id, game, start_time, end_time, sample_rate):
+        """
+        Insert or update a session pushed from a local database, matched on (shimmer_id, start_time).
+
+        The times are cast to the column type, a microsecond parameter never equals the stored value rounded to
+        1/300 s, so the session would be inserted again and violate UX_session_shimmer_start_time.
+        """
+        with self.lock:
+            with self.cnxn.cursor() as cursor:
+                cursor.execute("""MERGE INTO dbo.session WITH (HOLDLOCK) AS target
+                USING (SELECT ?, ?, ?, CAST(? AS datetime), CAST(? AS datetime), ?)
+                    AS source (player_id, shimmer_id, game, start_time, end_time, sample_rate)
+                ON (target.shimmer_id = source.shimmer_id AND target.start_time = source.start_time)
+                WHEN MATCHED THEN
+                    UPDATE SET target.end_time = source.end_time,
+                               target.sample_rate = COALESCE(target.sample_rate, source.sample_rate)
+                WHEN NOT MATCHED THEN
+                    INSERT (player_id, shimmer_id, game, start_time, end_time, sample_rate)
+                    VALUES (source.player_id, source.shimmer_id, source.game, source.start_time, source.end_time,
+                            source.sample_rate)
+                OUTPUT INSERTED.id;
+                """, (player_id, shimmer_id, game, start_time, end_time, sample_rate))
+                session_id = cursor.fetchone()[0]
+            self.cnxn.commit()
+        return session_id
+
+    def merge_samples(self, shimmer_id, samples: pd.DataFrame):
+        """
+        Insert samples that aren't in sensor_data yet, so sending the same batch twice is harmless.
+
+        The batch is bulk inserted into a temp table and merged with a single statement, in one transaction.
+        """
+        if samples.empty:
+            return
+        with self.lock:
+            cursor = self.cnxn.cursor()
+            try:
+                cursor.execute("""
+                    CREATE TABLE #sensor_data_batch (
+                        shimmer_id int NOT NULL,
+                        datetime datetime2(6) NOT NULL,
+                        data_timestamp int NOT NULL,
+                        gsr_raw int NOT NULL,
+                        ppg_raw int NOT NULL,
+                        quality tinyint NOT NULL,
+                        session_id int NULL
+                    )
+                    """)
+                cursor.fast_executemany = True
+                cursor.executemany("""
+                    INSERT INTO #sensor_data_batch (shimmer_id, datetime, data_timestamp, gsr_raw, ppg_raw, quality,
+                                                    session_id)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                    """, self.sample_rows(shimmer_id, samples))
+                cursor.execute("""
+                    MERGE INTO dbo.sensor_data WITH (HOLDLOCK) AS target
+                    USING #sensor_data_batch AS source
+                    ON (target.shimmer_id = source.shimmer_id AND target.datetime = source.datetime)
+                    WHEN NOT MATCHED THEN
+                        INSERT (shimmer_id, datetime, data_timestamp, gsr_raw, ppg_raw, quality, session_id)
+                        VALUES (source.shimmer_id, source.datetime, source.data_timestamp, source.gsr_raw,
+                                source.ppg_raw, source.quality, source.session_id);
+                    """)
+                cursor.execute("DROP TABLE #sensor_data_batch")
+                self.cnxn.commit()
+            except Exception:
+                # Also drops the temp table, it was created in this transaction
+                self.cnxn.rollback()
+                raise
+            finally:
+                cursor.close()
+
+    def merge_events(self, events: pd.DataFrame):
+        """
+        Insert events that aren't in measurement yet, matched on (shimmer_id, event, datetime). The datetime is cast
+        for the same reason as in merge_session.
+        """
+        if events.empty:
+            return
+        rows = list(zip([None if pd.isna(session_id) else int(session_id) for session_id in events['session_id']],
+                        events['player_id'].astype(np.int64).tolist(),
+                        events['shimmer_id'].astype(np.int64).tolist(),
+                        events['event'].tolist(),
+                        events['note'].tolist(),
+                        pd.to_datetime(events['datetime']).dt.to_pydatetime().tolist()))
+        self.executemany("""
+            MERGE INTO dbo.measurement WITH (HOLDLOCK) AS target
+            USING (SELECT ?, ?, ?, ?, ?, CAST(? AS datetime)) AS source (session_id, player_id, shimmer_id, event, note,
+                                                                         datetime)
+            ON (target.shimmer_id = source.shimmer_id AND target.event = source.event
+                AND target.datetime = source.datetime)
+            WHEN NOT MATCHED THEN
+                INSERT (session_id, player_id, shimmer_id, event, note, datetime)
+                VALUES (source.session_id, source.player_id, source.shimmer_id, source.event, source.note,
+                        source.datetime);
+            """, rows)
+
+
+def _adapt_datetime(value):
+    # Fixed width so string comparison in SQLite matches datetime order
+    return value.isoformat(" ", timespec="microseconds")
+
+
+sqlite3.register_adapter(datetime, _adapt_datetime)
+sqlite3.register_adapter(pd.Timestamp, _adapt_datetime)
+sqlite3.register_adapter(np.int64, int)
+sqlite3.register_adapter(np.int32, int)
+sqlite3.register_converter("timestamp", lambda value: datetime.fromisoformat(value.decode()))
+
+
+class SqliteStorage(Storage):
+    """
+    Embedded local database, so the dashboard and the devices also work without the server.
+
+    Samples are numbered in insert order, which is what the sync agent keeps track of. Reads by shimmer and time
+    range go through the unique (shimmer_id, datetime) index, reads of a session through ix_sensor_data_session.
+    WAL and synchronous=NORMAL keep the bulk inserts from waiting on an fsync per commit.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS player (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL UNIQUE
+        );
+        CREATE TABLE IF NOT EXISTS shimmer (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL UNIQUE,
+            port TEXT,
+            battery_perc REAL
+        );
+        CREATE TABLE IF NOT EXISTS session (
+            id INTEGER PRIMARY KEY,
+            player_id INTEGER NOT NULL REFERENCES player (id),
+            shimmer_id INTEGER NOT NULL REFERENCES shimmer (id),
+            game TEXT,
+            start_time timestamp NOT NULL,
+            end_time timestamp,
+            sample_rate REAL
+        );
+        CREATE TABLE IF NOT EXISTS measurement (
+            id INTEGER PRIMARY KEY,
+            player_id INTEGER NOT NULL REFERENCES player (id),
+            shimmer_id INTEGER REFERENCES shimmer (id),
+            event TEXT NOT NULL,
+            note TEXT,
+            datetime timestamp NOT NULL,
+            session_id INTEGER REFERENCES session (id)
+        );
+        CREATE INDEX IF NOT EXISTS ix_measurement_shimmer_event_datetime ON measurement (shimmer_id, event, datetime);
+        CREATE TABLE IF NOT EXISTS sensor_data (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,  -- insert order, the sync watermark
+            shimmer_id INTEGER NOT NULL REFERENCES shimmer (id),
+            datetime timestamp NOT NULL,
+            data_timestamp INTEGER NOT NULL,
+            gsr_raw INTEGER NOT NULL,
+            ppg_raw INTEGER NOT NULL,
+            quality INTEGER NOT NULL DEFAULT 0,
+            session_id INTEGER REFERENCES session (id),
+            UNIQUE (shimmer_id, datetime)
+        );
+        CREATE INDEX IF NOT EXISTS ix_sensor_data_session ON sensor_data (session_id, datetime);
+        CREATE TABLE IF NOT EXISTS sync_state (
+            name TEXT PRIMARY KEY,
+            value TEXT
+        );
+    """
+
+    def __init__(self, path='psv_local.db'):
+        cnxn = sqlite3.connect(path, detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread=False)
+        cnxn.execute("PRAGMA journal_mode = WAL")
+        cnxn.execute("PRAGMA synchronous = NORMAL")
+        cnxn.execute("PRAGMA temp_store = MEMORY")
+        cnxn.execute("PRAGMA cache_size = -65536")  # 64 MB
+        cnxn.executescript(self.SCHEMA)
+        super().__init__(cnxn)
+        self.path = path
+        self.sync_agent = None
+
+    def close(self):
+        # Give the sync agent a last chance to push before the connection goes away
+        if self.sync_agent:
+            self.sync_agent.stop()
+            self.sync_agent = None
+        super().close()
+
+    def register_shimmer(self, name, port, battery_perc):
+        with self.lock:
+            shimmer_id = self.cnxn.execute("""
+                INSERT INTO shimmer (name, port, battery_perc) VALUES (?, ?, ?)
+                ON CONFLICT (name) DO UPDATE SET port = excluded.port, battery_perc = excluded.battery_perc
+                RETURNING id
+                """, (name, port, battery_perc)).fetchone()[0]
+            self.cnxn.commit()
+        return shimmer_id
+
+    def insert_session(self, cursor, player_id, shimmer_id, game, start_time):
+        cursor.execute("""
+            INSERT INTO session (player_id, shimmer_id, game, start_time)
+            VALUES (?, ?, ?, ?)
+            RETURNING id
+            """, (player_id, shimmer_id, game, start_time))
+        return cursor.fetchone()[0]
+
+    # Store-and-forward bookkeeping, see sync.py
+
+    def get_sync_state(self, name, default=None):
+        with self.lock:
+            row = self.cnxn.execute("SELECT value FROM sync_state WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else default
+
+    def set_sync_state(self, name, value):
+        self.execute("""
+            INSERT INTO sync_state (name, value) VALUES (?, ?)
+            ON CONFLICT (name) DO UPDATE SET value = excluded.value
+            """, (name, str(value)))
+
+    def replace_players(self, players: pd.DataFrame):
+        """Mirror the central player table, so ids match when events are pushed back."""
+        rows = list(zip(players['id'].astype(np.int64).tolist(), players['name'].str.strip().tolist()))
+        self.executemany("""
+            INSERT INTO player (id, name) VALUES (?, ?)
+            ON CONFLICT (id) DO UPDATE SET name = excluded.name
+            """, rows)
+
+    def fetch_sessions_after(self, last_id):
+        return self.read("""
+            SELECT se.*, s.name, s.port, s.battery_perc
+            FROM session se
+            JOIN shimmer s ON s.id = se.shimmer_id
+            WHERE se.id > ?
+            ORDER BY se.id
+            """, params=(int(last_id),), parse_dates=['start_time', 'end_time'])
+
+    def fetch_events_after(self, last_id, limit):
+        return self.read("""
+            SELECT m.*, s.name AS shimmer_name
+            FROM measurement m
+            LEFT JOIN shimmer s ON s.id = m.shimmer_id
+            WHERE m.id > ?
+            ORDER BY m.id
+            LIMIT ?
+            """, params=(int(last_id), int(limit)), parse_dates=['datetime'])
+
+    def fetch_samples_after(self, last_id, limit):
+        return self.read("""
+            SELECT d.*, s.name AS shimmer_name
+            FROM sensor_data d
+            JOIN shimmer s ON s.id = d.shimmer_id
+            WHERE d.id > ?
+            ORDER BY d.id
+            LIMIT ?
+            """, params=(int(last_id), int(limit)), parse_dates=['datetime'])
+
+    def count_samples_after(self, last_id):
+        with self.lock:
+            return self.cnxn.execute("""
+                SELECT COUNT(*), MIN(datetime) FROM sensor_data
+                WHERE id > ?
+                """, (int(last_id),)).fetchone()
@@ -0,0 +1,174 @@
+import random
+import threading
+from datetime import datetime
+import pandas as pd
+from storage import SqliteStorage, SqlServerStorage
+
+
+class SyncAgent:
+    """
+    Pushes everything recorded in the local database to the central SQL Server in the background.
+
+    The acquisition thread only ever writes to the local SqliteStorage, so a slow or unreachable server never
+    reaches it. Each table keeps a watermark in sync_state of what has been pushed, and the server side uses MERGE,
+    so a batch that is sent twice after a failure doesn't create duplicates.
+    """
+
+    def __init__(self, local: SqliteStorage, batch_size: int = 5000, interval: float = 5.0,
+                 max_backoff: float = 300.0, connect=SqlServerStorage):
+        self.local = local
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_backoff = max_backoff
+        self.connect = connect
+
+        self.central = None
+        self.shimmer_ids = {}  # local shimmer name -> central shimmer id
+        self.session_ids = {}  # local session id -> central session id
+        self.failures = 0
+        self.last_success = None
+        self.last_error = None
+
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="SyncAgent", daemon=True)
+        self.thread.start()
+
+    def stop(self, flush: bool = True):
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join(timeout=10)
+            self.thread = None
+        if flush:
+            try:
+                self.sync_once()
+            except Exception as e:
+                print(f"Final sync failed, data stays in {self.local.path} until the next run. Error: {e}")
+        self.disconnect()
+
+    def run(self):
+        while not self.stop_event.is_set():
+            try:
+                self.sync_once()
+                delay = self.interval
+            except Exception as e:
+                self.failures += 1
+                self.last_error = str(e)
+                self.disconnect()
+                # Exponential backoff with jitter, so several laptops don't hammer the server at the same moment
+                delay = min(self.max_backoff, self.interval * 2 ** self.failures) * random.uniform(0.5, 1.0)
+                print(f"Sync failed ({self.failures} in a row), retrying in {delay:.0f}s. Error: {e}")
+            self.stop_event.wait(delay)
+
+    def disconnect(self):
+        if self.central:
+            try:
+                self.central.close()
+            except Exception:
+                pass
+        self.central = None
+
+    def sync_once(self):
+        if self.central is None:
+            self.central = self.connect()
+            self.shimmer_ids = {}
+            self.session_ids = {}
+
+        # Players are managed centrally, keep the local copy up to date so offline sessions use the same ids
+        self.local.replace_players(self.central.fetch_players())
+
+        # Sessions first, events and samples refer to them
+        self.push_sessions()
+        self.push_events()
+        self.push_samples()
+
+        self.failures = 0
+        self.last_error = None
+        self.last_success = datetime.now()
+
+    def central_shimmer_id(self, shimmer):
+        # Local and central ids differ, shimmers are matched on their unique name
+        if shimmer['name'] not in self.shimmer_ids:
+            self.shimmer_ids[shimmer['name']] = self.central.register_shimmer(
+                shimmer['name'], shimmer['port'], shimmer['battery_perc'])
+        return self.shimmer_ids[shimmer['name']]
+
+    def central_session_id(self, session_id):
+        # Sessions are matched on (shimmer, start_time), samples recorded outside a session have none
+        if pd.isna(session_id):
+            return None
+        session_id = int(session_id)
+        if session_id not in self.session_ids:
+            self.merge_session(self.local.fetch_sessions_after(session_id - 1).iloc[0])
+        return self.session_ids[session_id]
+
+    def merge_session(self, session):
+        self.session_ids[int(session['id'])] = self.central.merge_session(
+            int(session['player_id']),
+            self.central_shimmer_id(session),
+            session['game'],
+            session['start_time'].to_pydatetime(),
+            None if pd.isna(session['end_time']) else session['end_time'].to_pydatetime(),
+            None if pd.isna(session['sample_rate']) else float(session['sample_rate']))
+
+    def push_sessions(self):
+        last_id = int(self.local.get_sync_state('session', 0))
+        sessions = self.local.fetch_sessions_after(last_id)
+        if sessions.empty:
+            return
+        for _, session in sessions.iterrows():
+            self.merge_session(session)
+
+        # Running sessions are pushed again until their end time is known
+        running = sessions[sessions['end_time'].isna()]
+        self.local.set_sync_state('session', int(running['id'].min()) - 1 if not running.empty
+                                  else int(sessions['id'].max()))
+
+    def push_events(self):
+        shimmers = self.local.fetch_shimmers().set_index('name', drop=False)
+        last_id = int(self.local.get_sync_state('measurement', 0))
+
+        while True:
+            events = self.local.fetch_events_after(last_id, self.batch_size)
+            if events.empty:
+                break
+            events['shimmer_id'] = events['shimmer_name'].map(
+                lambda name: self.central_shimmer_id(shimmers.loc[name]))
+            events['session_id'] = events['session_id'].map(self.central_session_id)
+            self.central.merge_events(events)
+
+            last_id = int(events['id'].max())
+            self.local.set_sync_state('measurement', last_id)
+
+    def push_samples(self):
+        # The watermark is the local insert order, so rows written late with an earlier datetime aren't skipped
+        shimmers = self.local.fetch_shimmers().set_index('name', drop=False)
+        last_id = int(self.local.get_sync_state('sensor_data', 0))
+
+        while True:
+            samples = self.local.fetch_samples_after(last_id, self.batch_size)
+            if samples.empty:
+                break
+            samples = samples.rename(columns={'data_timestamp': 'timestamp'})
+            samples['session_id'] = samples['session_id'].map(self.central_session_id)
+            for name, shimmer_samples in samples.groupby('shimmer_name'):
+                self.central.merge_samples(self.central_shimmer_id(shimmers.loc[name]), shimmer_samples)
+
+            last_id = int(samples['id'].max())
+            self.local.set_sync_state('sensor_data', last_id)
+
+    def status(self):
+        """How far the central database is behind the local one."""
+        pending, oldest = self.local.count_samples_after(int(self.local.get_sync_state('sensor_data', 0)))
+        oldest = datetime.fromisoformat(oldest) if oldest else None
+
+        return {
+            'online': self.central is not None and self.last_error is None,
+            'pending_samples': pending,
+            'lag_seconds': (datetime.now() - oldest).total_seconds() if oldest else 0.0,
+            'last_success': self.last_success,
+            'last_error': self.last_error,
+            'failures': self.failures,
+        }
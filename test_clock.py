@@ -0,0 +1,57 @@
+import numpy as np
+from clock import TICK_RATE, TICK_WRAP, ClockAligner
+
+RATE = 128.0
+BATCH = 32
+
+
+def align_batches(arrival_delays, start_tick=0, rate=RATE):
+    """Timestamps of consecutive batches arriving with the given extra delays (seconds) after their last sample."""
+    clock = ClockAligner(rate)
+    period_ticks = int(TICK_RATE / rate)
+    host_start = 1_700_000_000.0
+    batches = []
+    for number, delay in enumerate(arrival_delays):
+        index = number * BATCH + np.arange(BATCH)
+        ticks = (start_tick + index * period_ticks) % TICK_WRAP
+        host_time = host_start + (index[-1] + 1) / rate + delay
+        batches.append(clock.align(ticks, host_time))
+    return np.concatenate(batches)
+
+
+def test_timestamps_increase_with_jitter():
+    rng = np.random.default_rng(0)
+    times = align_batches(rng.exponential(0.05, 2000))
+    assert np.all(np.diff(times) > 0)
+
+
+def test_timestamps_increase_after_a_late_first_batch():
+    delays = np.full(50, 0.01)
+    delays[0] = 0.5
+    times = align_batches(delays)
+    assert np.all(np.diff(times) > 0)
+
+
+def test_timestamps_increase_across_a_counter_wrap():
+    rng = np.random.default_rng(1)
+    times = align_batches(rng.exponential(0.05, 200), start_tick=TICK_WRAP - 50 * 256)
+    assert np.all(np.diff(times) > 0)
+
+
+def test_timestamps_catch_up_after_a_late_first_batch():
+    delays = np.full(500, 0.01)
+    delays[0] = 0.5
+    times = align_batches(delays)
+    # Samples are 1/128 s apart, the last one is back near its arrival time instead of 0.5 s ahead
+    expected = 1_700_000_000.0 + len(times) / RATE + 0.01
+    assert abs(times[-1] - expected) < 0.05
+
+
+def test_timestamps_stay_apart_in_the_sensor_data_key_at_high_rates():
+    rng = np.random.default_rng(2)
+    delays = rng.exponential(0.05, 500)
+    delays[0] = 0.5
+    for rate in (256.0, 512.0, 1024.0):
+        # sensor_data.datetime is datetime2(6)
+        micros = np.rint(align_batches(delays, rate=rate) * 1e6)
+        assert np.all(np.diff(micros) > 0)
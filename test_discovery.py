@@ -0,0 +1,85 @@
+import threading
+import time
+import pytest
+from discovery import DeviceDiscovery, simulated_ports
+from storage import SqliteStorage
+
+
+@pytest.fixture
+def storage(tmp_path):
+    storage = SqliteStorage(str(tmp_path / 'discovery.db'))
+    yield storage
+    storage.close()
+
+
+def discover(storage, count, delay=0.5, silent=(), **kwargs):
+    list_candidates, connect = simulated_ports(count, delay=delay, silent=silent)
+    return DeviceDiscovery(storage, connect=connect, list_candidates=list_candidates, **kwargs)
+
+
+def test_ports_are_probed_in_parallel(storage):
+    # One after the other takes 3 x 0.75s for the Shimmers and 3 x 0.5s for the other ports
+    discovery = discover(storage, 6, max_workers=8)
+    start = time.time()
+    discovery.scan()
+    elapsed = time.time() - start
+    found = [device.com_port for device in discovery.devices()]
+    discovery.stop()
+    assert elapsed < 2.0
+    assert found == ['SIM0', 'SIM2', 'SIM4']
+    assert sorted(discovery.failed) == ['SIM1', 'SIM3', 'SIM5']
+
+
+def test_claim_take_and_release(storage):
+    discovery = discover(storage, 4, delay=0.1)
+    discovery.scan()
+    assert [device.com_port for device in discovery.devices()] == ['SIM0', 'SIM2']
+
+    assert discovery.claim('SIM0')
+    assert not discovery.claim('SIM0')
+    device = discovery.take('SIM0')
+    assert device.name == 'Shimmer-SIM0'
+    assert device.shimmer_id is not None
+    assert discovery.take('SIM0') is None
+
+    # A taken port isn't probed again until it is released
+    discovery.scan()
+    assert [device.com_port for device in discovery.devices()] == ['SIM2']
+    device.close()
+    discovery.release('SIM0')
+    discovery.scan()
+    assert [device.com_port for device in discovery.devices()] == ['SIM0', 'SIM2']
+    discovery.stop()
+
+
+def test_a_silent_port_times_out_without_holding_up_the_scan(storage):
+    discovery = discover(storage, 4, delay=0.1, silent=(2,), handshake_timeout=1.0)
+    start = time.time()
+    discovery.scan()
+    elapsed = time.time() - start
+    found = [device.com_port for device in discovery.devices()]
+    discovery.stop()
+    assert elapsed < 3.0
+    assert found == ['SIM0']
+    assert 'No answer' in discovery.failed['SIM2']
+
+
+def test_a_device_going_out_of_range_is_dropped(storage):
+    discovery = discover(storage, 2, delay=0.1, query_timeout=1.0)
+    discovery.scan()
+    device = discovery.devices()[0]
+    device.shim_dev.out_of_range = True
+
+    refresh = threading.Thread(target=discovery.refresh, args=(device,))
+    refresh.start()
+    time.sleep(0.2)
+    # Start doesn't wait for the hanging battery query
+    assert discovery.claim('SIM0')
+    with pytest.raises(RuntimeError):
+        discovery.take('SIM0')
+
+    refresh.join(timeout=5)
+    assert not refresh.is_alive()
+    assert device.closed
+    assert discovery.take('SIM0') is None
+    discovery.stop()
@@ -0,0 +1,94 @@
+import asyncio
+import threading
+import time
+from datetime import datetime
+from live_feed import EPOCH, LiveFeedServer, simulate_clients, simulate_device
+
+
+async def start_server(server):
+    serving = asyncio.create_task(server.serve('127.0.0.1', 0))
+    while server.port is None:
+        await asyncio.sleep(0.01)
+    return serving
+
+
+def feed(port, clients, duration, slow_every):
+    """Clients of a feed of one simulated device, started before the server like run_simulation does."""
+
+    async def scenario():
+        stop = threading.Event()
+        device, bus = simulate_device(port, stop=stop)
+        server = LiveFeedServer([port])
+        server.buses[port] = bus
+        server.last_change[port] = time.monotonic()
+        serving = await start_server(server)
+        try:
+            return await simulate_clients(clients, server.port, duration, slow_every=slow_every, port=port)
+        finally:
+            serving.cancel()
+            stop.set()
+            device.join()
+
+    return asyncio.run(scenario())
+
+
+def test_sixty_clients_receive_frames():
+    results = feed('TEST_FEED_MANY', 60, 3.0, slow_every=1000)
+    # Client 0 is the only slow one
+    for frames, samples, latency, newest in results[1:]:
+        assert frames >= 5
+        assert samples >= 128
+        assert latency < 1.0
+
+
+def test_slow_clients_dont_stall_fast_ones():
+    results = feed('TEST_FEED_SLOW', 20, 4.0, slow_every=4)
+    slow = [result for number, result in enumerate(results) if number % 4 == 0]
+    fast = [result for number, result in enumerate(results) if number % 4 != 0]
+    assert max(latency for frames, samples, latency, newest in fast) < 1.0
+    assert min(frames for frames, samples, latency, newest in fast) >= 10
+    # Slow clients get fewer, larger frames but still keep up
+    assert all(frames > 0 for frames, samples, latency, newest in slow)
+
+
+def test_clients_follow_a_restarted_daemon():
+    port = 'TEST_FEED_RESTART'
+
+    async def status(server_port):
+        reader, writer = await asyncio.open_connection('127.0.0.1', server_port)
+        writer.write(f"GET /events/{port} HTTP/1.1\r\nHost: localhost\r\n\r\n".encode())
+        line = await reader.readline()
+        writer.close()
+        return line.split()[1]
+
+    async def scenario():
+        server = LiveFeedServer([port], reattach_after=0.5)
+        serving = await start_server(server)
+        stop = threading.Event()
+        try:
+            # No daemon yet
+            assert await status(server.port) == b'503'
+
+            device, bus = simulate_device(port, stop=stop)
+            clients = asyncio.create_task(simulate_clients(5, server.port, 5.0, slow_every=1000, port=port,
+                                                           delay=0.5))
+            await asyncio.sleep(2.0)
+            stop.set()
+            await asyncio.to_thread(device.join)
+
+            # The daemon comes back with a new segment under the same name
+            await asyncio.sleep(0.5)
+            restarted = (datetime.now() - EPOCH).total_seconds()
+            stop = threading.Event()
+            device, bus = simulate_device(port, stop=stop)
+            results = await clients
+        finally:
+            serving.cancel()
+            stop.set()
+        device.join()
+        return restarted, results
+
+    restarted, results = asyncio.run(scenario())
+    # Client 0 is slow and still works through its backlog
+    for frames, samples, latency, newest in results[1:]:
+        assert newest > restarted + 1.0